@@ -8,7 +8,12 @@ __copyright__   = "BSD"
 
 
 import sys
+import time
+import uuid
+import Queue
 import logging
+import threading
+import collections
 import boto
 import ConfigParser
 import os.path
@@ -36,6 +41,155 @@ class OCBError(RuntimeError):
     pass
 
 
+class RequestPolicy(object):
+    """
+    Opt-in request policy for FCU and LBU connections
+        - ClientToken added to idempotent create calls so their retries are safe
+        - short socket timeout and boto retries for Describe and ClientToken calls only,
+          other calls keep the connection timeout and boto retries
+        - Describe calls slower than a latency percentile are hedged with a duplicate request
+    Latencies are measured until the response headers are received, boto returns
+    the response before its body is read. The transfer time of large responses is
+    not part of the percentile and a hedge is only sent while waiting for headers.
+    """
+
+    IDEMPOTENT_ACTIONS = ('RunInstances', 'CreateNatGateway', 'CopyImage')
+
+    def __init__(self, timeout=10, num_retries=3, hedge_percentile=95, hedge_min_samples=20, hedge_min_delay=0.5, window=200):
+        """
+        :param timeout: socket timeout of Describe and ClientToken calls in seconds
+        :type timeout: int
+        :param num_retries: boto retries of Describe and ClientToken calls on timeout, connection error and 5xx
+        :type num_retries: int
+        :param hedge_percentile: latency percentile after which a Describe call is hedged
+        :type hedge_percentile: int
+        :param hedge_min_samples: calls of an action to observe before hedging it
+        :type hedge_min_samples: int
+        :param hedge_min_delay: never hedge a call before this delay in seconds
+        :type hedge_min_delay: float
+        :param window: number of latencies kept by action
+        :type window: int
+        """
+        self.timeout = timeout
+        self.num_retries = num_retries
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self.window = window
+        self.__latencies = {}
+        self.__lock = threading.Lock()
+
+    def install(self, conn, log):
+        """
+        Apply the policy on a boto query connection
+        :param conn: FCU or LBU connection
+        :type conn: boto.connection.AWSQueryConnection
+        :param log: log function
+        :type log: function
+        """
+        local = threading.local()
+        default_timeout = conn.http_connection_kwargs.get('timeout')
+        make_request = conn.make_request
+        mexe = conn._mexe
+        get_http_connection = conn.get_http_connection
+        new_http_connection = conn.new_http_connection
+
+        def with_timeout(connection):
+            # Pooled connections keep the socket timeout of their previous call
+            timeout = getattr(local, 'timeout', default_timeout)
+            connection.timeout = timeout
+            if getattr(connection, 'sock', None) is not None:
+                connection.sock.settimeout(timeout)
+            return connection
+
+        def policy_mexe(request, sender=None, override_num_retries=None, retry_handler=None):
+            if override_num_retries is None:
+                override_num_retries = getattr(local, 'num_retries', None)
+            return mexe(request, sender, override_num_retries, retry_handler)
+
+        def policy_make_request(action, params=None, path='/', verb='GET'):
+            params = dict(params or {})
+            if action in self.IDEMPOTENT_ACTIONS and 'ClientToken' not in params:
+                params['ClientToken'] = uuid.uuid4().hex
+            # A timed out and retried create without ClientToken may create a duplicate
+            safe = action.startswith('Describe') or 'ClientToken' in params
+
+            def call():
+                local.timeout = self.timeout if safe else default_timeout
+                local.num_retries = self.num_retries if safe else None
+                return make_request(action, params, path, verb)
+            threshold = self.threshold(action) if action.startswith('Describe') else None
+            if threshold is None:
+                return self.__timed(action, call)
+            return self.__hedged(action, call, threshold, log)
+        conn.get_http_connection = lambda host, port, is_secure: with_timeout(get_http_connection(host, port, is_secure))
+        conn.new_http_connection = lambda host, port, is_secure: with_timeout(new_http_connection(host, port, is_secure))
+        conn._mexe = policy_mexe
+        conn.make_request = policy_make_request
+
+    def threshold(self, action):
+        """
+        :param action: API action
+        :type action: str
+        :return: hedge_percentile latency of action (at least hedge_min_delay), None until enough calls are observed
+        :rtype: float
+        """
+        with self.__lock:
+            latencies = sorted(self.__latencies.get(action, []))
+        if not latencies or len(latencies) < self.hedge_min_samples:
+            return None
+        return max(self.hedge_min_delay, latencies[min(len(latencies) - 1, len(latencies) * self.hedge_percentile // 100)])
+
+    def __timed(self, action, call):
+        start = time.time()
+        response = call()
+        with self.__lock:
+            self.__latencies.setdefault(action, collections.deque(maxlen=self.window)).append(time.time() - start)
+        return response
+
+    def __hedged(self, action, call, threshold, log):
+        """
+        Send call, and a duplicate if no answer came after threshold seconds.
+        First response wins, the other one is drained so its connection goes back to the pool.
+        """
+        results = Queue.Queue()
+        state = {'done': False, 'pending': 0}
+
+        def attempt():
+            try:
+                result = (True, self.__timed(action, call))
+            except Exception as err:
+                result = (False, err)
+            with self.__lock:
+                state['pending'] -= 1
+                if not state['done'] and (result[0] or state['pending'] == 0):
+                    state['done'] = True
+                    results.put(result)
+                    return
+            if result[0]:
+                result[1].read()
+
+        def launch():
+            with self.__lock:
+                if state['done']:
+                    return
+                state['pending'] += 1
+            thread = threading.Thread(target=attempt)
+            thread.daemon = True
+            thread.start()
+
+        launch()
+        try:
+            succeeded, result = results.get(timeout=threshold)
+        except Queue.Empty:
+            log('{0} slower than {1:.2f}s, hedging'.format(action, threshold), 'info')
+            launch()
+            succeeded, result = results.get()
+        if not succeeded:
+            raise result
+        return result
+
+
 class OCBase(object):
     """
     Manage API connections (FCU, OSU, EIM, LBU) and provide centralized logging system
@@ -43,7 +197,7 @@ class OCBase(object):
 
     __metaclass__ = Singleton
 
-    def __init__(self, region='eu-west-2', settings_paths=['~/.osc_cloud_builder/services.ini', '/etc/osc_cloud_builder/services.ini'], is_secure=True, boto_debug=0, debug_filename='/tmp/ocb.log', debug_level='INFO'):
+    def __init__(self, region='eu-west-2', settings_paths=['~/.osc_cloud_builder/services.ini', '/etc/osc_cloud_builder/services.ini'], is_secure=True, boto_debug=0, debug_filename='/tmp/ocb.log', debug_level='INFO', request_policy=None):
         """
         :param region: region choosen for loading settings.ini section
         :type region: str
@@ -55,11 +209,17 @@ class OCBase(object):
         :type boto_debug: int
         :param debug_filename: File to store logs
         :type debug_filename: str
+        :param request_policy: timeout, idempotency and hedging policy applied on FCU and LBU
+        :type request_policy: RequestPolicy
         """
         self.__logger_setup(debug_filename, debug_level)
         self.region = region
         self.settings_paths = settings_paths
         self.__connections_setup(is_secure, boto_debug)
+        if request_policy:
+            for conn in (self.fcu, self.lbu):
+                if conn is not None:
+                    request_policy.install(conn, self.log)
 
     def __logger_setup(self, debug_filename, debug_level):
         """
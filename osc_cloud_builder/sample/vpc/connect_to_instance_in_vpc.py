@@ -11,6 +11,8 @@ __copyright__   = "BSD"
 
 from osc_cloud_builder.OCBase import OCBase
 from osc_cloud_builder.tools.create_key_pair import create_key_pair
+from osc_cloud_builder.tools.image_cache import ImageCatalogCache
+from osc_cloud_builder.tools.ssh_executor import BouncerExecutor
 from vpc import vpc_with_two_subnets, vpc_teardown
 from fabric.api import run, env
 
@@ -37,16 +39,18 @@ def connect_to_instance_in_ssh(address, keypair_path, user='root'):
 if __name__ == '__main__':
     ocb = OCBase(debug_level='INFO')
     ocb.activate_stdout_logging()
-    omi = ocb.fcu.get_all_images(filters={'root-device-type': 'ebs',
-                                          'architecture': 'x86_64',
-                                          'name': ['centos6*', 'centos-7*', 'Centos7*', 'Centos-7*']})[0]
+    omi = ImageCatalogCache().find(root_device_type='ebs',
+                                   architecture='x86_64',
+                                   name=['centos6*', 'centos-7*', 'Centos7*', 'Centos-7*'])[0]
     kp = create_key_pair()
-    vpc, instance_nat, instance_bouncer, instance_private = vpc_with_two_subnets.setup_vpc('ami-2472c655', kp['name'])
+    vpc, instance_bouncer, instance_private = vpc_with_two_subnets.setup_vpc(omi['id'], kp['name'], tag_prefix='test-connect-to-instance')
     ocb.log('vpc {0} created'.format(vpc.id), level='INFO')
     try:
-        connect_to_instance_in_ssh(instance_bouncer.ip_address, kp['path'], tag_prefix='test-connect-to-instance')
+        connect_to_instance_in_ssh(instance_bouncer.ip_address, kp['path'])
     except Exception as err:
         ocb.log('Can not connect to instance {0} with address {1} because {2}'.format(instance_bouncer.id, instance_bouncer.ip_address, err), level='INFO')
+    with BouncerExecutor.from_instance(instance_bouncer, kp['path']) as executor:
+        executor.run([instance_private.private_ip_address], 'ls -la /root')
     if raw_input('Teardown VPC {0} ? [Y/n] '.format(vpc.id)) != 'n':
         vpc_teardown.teardown(vpc.id, terminate_instances=True)
 
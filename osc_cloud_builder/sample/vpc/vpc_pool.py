@@ -0,0 +1,275 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Warm pool of VPCs built by setup_vpc
+    - VPCs of the pool are tagged with the pool name and their state
+        - available, leased, recycling or broken
+    - lease() claims an available VPC with a lease tag
+    - release() replaces the private instance and puts the VPC back in the pool,
+      a VPC which can not be recycled is marked broken and torn down
+    - a background thread keeps size VPCs available
+
+    >>>pool = VpcPool('ci', 4, omi_id, key_name)
+    >>>pool.start()
+    >>>vpc, instance_bouncer, instance_private = pool.lease()
+    >>>pool.release(vpc.id)
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+
+import os
+import time
+import uuid
+import random
+import tempfile
+import threading
+from boto.exception import EC2ResponseError
+from osc_cloud_builder.OCBase import OCBase, OCBError, SLEEP_SHORT
+from osc_cloud_builder.tools.wait_for import wait_state
+from osc_cloud_builder.sample.vpc.vpc_with_two_subnets import setup_vpc, rollback_setup
+from osc_cloud_builder.sample.vpc.vpc_teardown import teardown
+
+POOL_TAG = 'osc.ocb.pool'
+STATE_TAG = 'osc.ocb.pool.state'
+LEASE_TAG = 'osc.ocb.pool.lease'
+
+
+class VpcPool(object):
+    """
+    Keep ready to use VPCs and lease them with tags
+    """
+
+    def __init__(self, name, size, omi_id, key_name, instance_type='t2.medium', claim_delay=SLEEP_SHORT, journal_directory=None):
+        """
+        :param name: pool name, also used as tag_prefix
+        :type name: str
+        :param size: number of available VPCs to keep
+        :type size: int
+        :param omi_id: OMI identifier
+        :type omi_id: str
+        :param key_name: key pair name
+        :type key_name: str
+        :param instance_type: instance type
+        :type instance_type: str
+        :param claim_delay: seconds to wait before checking a lease claim
+        :type claim_delay: int
+        :param journal_directory: directory of setup_vpc journals
+        :type journal_directory: str
+        """
+        self.name = name
+        self.size = size
+        self.omi_id = omi_id
+        self.key_name = key_name
+        self.instance_type = instance_type
+        self.claim_delay = claim_delay
+        self.journal_directory = journal_directory or tempfile.gettempdir()
+        self.ocb = OCBase()
+        self.__building = 0
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def __set_state(self, vpc_id, state):
+        self.ocb.fcu.create_tags([vpc_id], {POOL_TAG: self.name, STATE_TAG: state})
+        self.ocb.log('Pool {0}: VPC {1} is {2}'.format(self.name, vpc_id, state), level='info')
+
+    def vpcs(self, state=None):
+        """
+        :param state: available, leased, recycling or broken
+        :type state: str
+        :return: VPCs of the pool
+        :rtype: list
+        """
+        filters = {'tag:{0}'.format(POOL_TAG): self.name}
+        if state:
+            filters['tag:{0}'.format(STATE_TAG)] = state
+        return self.ocb.fcu.get_all_vpcs(filters=filters)
+
+    def __instances(self, vpc_id):
+        """
+        :return: bouncer and private instances of a pool VPC
+        :rtype: tuple
+        """
+        instances = self.ocb.fcu.get_only_instances(filters={'vpc-id': vpc_id, 'instance-state-name': ['pending', 'running']})
+        instance_bouncer = [instance for instance in instances if instance.tags.get('Name', '').endswith('-bouncer')]
+        instance_private = [instance for instance in instances if not instance.tags.get('Name', '').endswith('-bouncer')]
+        return (instance_bouncer or [None])[0], (instance_private or [None])[0]
+
+    def build(self):
+        """
+        Build a VPC with setup_vpc and add it to the pool. A failed build is rolled back.
+        :return: vpc id
+        :rtype: str
+        """
+        with self.__lock:
+            self.__building += 1
+        return self.__build()
+
+    def __build(self):
+        """
+        Build a VPC already counted as building
+        :return: vpc id
+        :rtype: str
+        """
+        tag_prefix = '{0}-{1}'.format(self.name, uuid.uuid4().hex[:8])
+        journal_path = os.path.join(self.journal_directory, '{0}.journal'.format(tag_prefix))
+        try:
+            vpc, _, _ = setup_vpc(self.omi_id, self.key_name, instance_type=self.instance_type,
+                                  tag_prefix=tag_prefix, journal_path=journal_path)
+            self.__set_state(vpc.id, 'available')
+            os.remove(journal_path)
+            return vpc.id
+        except Exception as err:
+            self.ocb.log('Pool {0}: build of {1} failed, rolling back: {2}'.format(self.name, tag_prefix, err), 'error')
+            try:
+                rollback_setup(journal_path)
+            except Exception as rollback_err:
+                # Journal is kept so that rollback_setup can be run again on it
+                self.ocb.log('Pool {0}: rollback of {1} failed, journal kept in {2}: {3}'.format(self.name, tag_prefix, journal_path, rollback_err), 'error')
+                raise err
+            if os.path.exists(journal_path):
+                os.remove(journal_path)
+            raise
+        finally:
+            with self.__lock:
+                self.__building -= 1
+
+    def refill(self):
+        """
+        Build in background the VPCs missing to have size available ones
+        :return: threads building the missing VPCs
+        :rtype: list
+        """
+        with self.__lock:
+            missing = max(self.size - len(self.vpcs('available')) - len(self.vpcs('recycling')) - self.__building, 0)
+            self.__building += missing
+        threads = [threading.Thread(target=self.__build) for _ in range(missing)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        return threads
+
+    def __claim(self, vpc_id):
+        """
+        Tags are last writer wins: write our token, let concurrent claims land,
+        then the VPC is ours only if our token is still there. claim_delay must
+        be longer than the time between listing available VPCs and claiming one.
+        :param vpc_id: vpc id
+        :type vpc_id: str
+        :return: True if the VPC has been claimed
+        :rtype: bool
+        """
+        token = uuid.uuid4().hex
+        self.ocb.fcu.create_tags([vpc_id], {LEASE_TAG: token})
+        time.sleep(self.claim_delay)
+        tags = self.ocb.fcu.get_all_tags(filters={'resource-id': vpc_id, 'key': [LEASE_TAG, STATE_TAG]})
+        tags = dict((tag.name, tag.value) for tag in tags)
+        if tags.get(LEASE_TAG) != token or tags.get(STATE_TAG) != 'available':
+            return False
+        self.__set_state(vpc_id, 'leased')
+        return True
+
+    def lease(self, timeout=600):
+        """
+        Claim an available VPC, waiting for one up to timeout
+        :param timeout: seconds to wait for an available VPC
+        :type timeout: int
+        :return: VPC, bouncer instance and private instance as returned by setup_vpc
+        :rtype: tuple
+        :raises OCBError: When no VPC has been leased before timeout
+        """
+        timeout = time.time() + timeout
+        while time.time() < timeout:
+            available = self.vpcs('available')
+            random.shuffle(available)
+            for vpc in available:
+                if self.__claim(vpc.id):
+                    self.refill()
+                    instance_bouncer, instance_private = self.__instances(vpc.id)
+                    return vpc, instance_bouncer, instance_private
+            self.refill()
+            time.sleep(SLEEP_SHORT)
+        raise OCBError('No VPC available in pool {0}'.format(self.name))
+
+    def recycle(self, vpc_id):
+        """
+        Replace the private instance of a returned VPC and make it available again.
+        A VPC which can not be recycled is marked broken, so that refill() no longer
+        counts it, and torn down.
+        :param vpc_id: vpc id
+        :type vpc_id: str
+        :return: True if the VPC is available again
+        :rtype: bool
+        """
+        try:
+            self.__set_state(vpc_id, 'recycling')
+            _, instance = self.__instances(vpc_id)
+            if instance:
+                replacement = self.ocb.fcu.run_instances(image_id=instance.image_id,
+                                                         min_count=1, max_count=1,
+                                                         subnet_id=instance.subnet_id,
+                                                         security_group_ids=[group.id for group in instance.groups],
+                                                         instance_type=instance.instance_type,
+                                                         key_name=instance.key_name).instances[0]
+                self.ocb.fcu.create_tags([replacement.id], {'Name': instance.tags.get('Name', '')})
+                try:
+                    self.ocb.fcu.terminate_instances([instance.id])
+                except EC2ResponseError as err:
+                    self.ocb.log('Pool {0}: can not terminate {1}: {2}'.format(self.name, instance.id, err.message), 'warning')
+                if wait_state([replacement], 'running'):
+                    raise OCBError('replacement {0} is not running'.format(replacement.id))
+            self.ocb.fcu.delete_tags([vpc_id], [LEASE_TAG])
+            self.__set_state(vpc_id, 'available')
+            return True
+        except Exception as err:
+            self.ocb.log('Pool {0}: can not recycle VPC {1}, tearing it down: {2}'.format(self.name, vpc_id, err), 'error')
+        try:
+            self.__set_state(vpc_id, 'broken')
+            teardown(vpc_id, terminate_instances=True)
+        except Exception as err:
+            self.ocb.log('Pool {0}: teardown of broken VPC {1} failed: {2}'.format(self.name, vpc_id, err), 'error')
+        return False
+
+    def release(self, vpc_id):
+        """
+        Give back a leased VPC, it is recycled in background
+        :param vpc_id: vpc id
+        :type vpc_id: str
+        :return: recycling thread
+        :rtype: threading.Thread
+        """
+        thread = threading.Thread(target=self.recycle, args=(vpc_id,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def __run(self, interval):
+        while not self.__stop.is_set():
+            try:
+                for thread in self.refill():
+                    thread.join()
+            except Exception as err:
+                self.ocb.log('Pool {0}: refill error: {1}'.format(self.name, err), 'warning')
+            self.__stop.wait(interval)
+
+    def start(self, interval=60):
+        """
+        Refill the pool in background every interval seconds
+        :param interval: seconds between two refills
+        :type interval: int
+        """
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, args=(interval,))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Stop background refill, VPCs being built are finished
+        """
+        self.__stop.set()
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
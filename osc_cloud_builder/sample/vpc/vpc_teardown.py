@@ -12,26 +12,73 @@ import time
 from boto.ec2.ec2object import EC2Object
 from osc_cloud_builder.OCBase import OCBase, SLEEP_SHORT
 from osc_cloud_builder.tools.wait_for import wait_state
+from osc_cloud_builder.tools.journal import Journal
+from osc_cloud_builder.tools.tracer import traced
+from osc_cloud_builder.tools.tag_index import TagIndex
 from boto.exception import EC2ResponseError
 
-def teardown(vpc_to_delete, terminate_instances=False):
+
+def _instances(ocb, journal):
     """
-    Clean all ressouces attached to the vpc_to_delete
-    :param vpc_to_delete: vpc id to delete
-    :type vpc_to_delete: str
-    :param terminate_instances: continue teardown even if instances exists in the VPC
-    :type terminate_instances: bool
+    :param ocb: connection object
+    :type ocb: OCBase.OCBase
+    :param journal: teardown journal
+    :type journal: osc_cloud_builder.tools.journal.Journal
+    :return: VPC instances found at the beginning of the teardown
+    :rtype: list
     """
-    ocb = OCBase()
+    instance_ids = journal.step_data('discover_instances')['instance_ids']
+    if not instance_ids:
+        return []
+    return ocb.fcu.get_only_instances(instance_ids)
 
-    if terminate_instances is False and \
-       ocb.fcu.get_only_instances(filters={'vpc-id': vpc_to_delete, 'instance-state-name': 'running'}) and \
-       ocb.fcu.get_only_instances(filters={'vpc-id': vpc_to_delete, 'instance-state-name': 'stopped'}) :
-        ocb.log('Instances are still exists in {0}, teardown will not be executed'.format(vpc_to_delete) ,'error')
-        return
+def release_address(ocb, allocation_id):
+    """
+    Disassociate an EIP from its instance and release it. The address is read
+    again on each try, a nat gateway EIP is released once the nat gateway is deleted.
+    :param ocb: connection object
+    :type ocb: OCBase.OCBase
+    :param allocation_id: EIP allocation id
+    :type allocation_id: str
+    :return: False when the EIP is still allocated after all tries
+    :rtype: bool
+    """
+    for i in range(1, 24):
+        try:
+            addresses = ocb.fcu.get_all_addresses(allocation_ids=[allocation_id])
+            if not addresses:
+                return True
+            address = addresses[0]
+            if address.association_id and address.instance_id:
+                try:
+                    ocb.fcu.disassociate_address(association_id=address.association_id)
+                except EC2ResponseError as err:
+                    if err.error_code != 'InvalidAssociationID.NotFound':
+                        raise
+            ocb.fcu.release_address(allocation_id=allocation_id)
+            ocb.log('EIP {0} released'.format(address.public_ip), 'info')
+            return True
+        except EC2ResponseError as err:
+            if err.error_code == 'InvalidAllocationID.NotFound':
+                return True
+            ocb.log('Can not release EIP {0} yet: {1}'.format(allocation_id, err.message), 'warning')
+            time.sleep(SLEEP_SHORT)
+    return False
 
-    ocb.log('Deleting VPC {0}'.format(vpc_to_delete), 'info', __file__)
-    vpc_instances = ocb.fcu.get_only_instances(filters={'vpc-id': vpc_to_delete})
+@traced
+def _terminate_instances(ocb, vpc_to_delete, journal):
+    """
+    Stop then terminate VPC instances
+    :param ocb: connection object
+    :type ocb: OCBase.OCBase
+    :param vpc_to_delete: vpc id to delete
+    :type vpc_to_delete: str
+    :param journal: teardown journal
+    :type journal: osc_cloud_builder.tools.journal.Journal
+    :return: False when instances are not terminated
+    :rtype: bool
+    """
+    vpc_instances = _instances(ocb, journal)
     ocb.log('Termating VMs {0}'.format(vpc_instances), 'info')
 
     # Stop instances
@@ -61,44 +108,98 @@ def teardown(vpc_to_delete, terminate_instances=False):
             ocb.log('Terminate instance error: {0}'.format(err.message), 'warning')
 
     # Wait instance to be terminated
-    wait_state(vpc_instances, 'terminated')
+    not_terminated = wait_state(vpc_instances, 'terminated')
+    for instance in vpc_instances:
+        if instance not in not_terminated:
+            journal.deleted('instance', instance.id)
+    return not not_terminated
 
-    # Delete VPC-Peering connections
+@traced
+def _delete_vpc_peerings(ocb, vpc_to_delete, journal):
+    """
+    Delete VPC-Peering connections
+    :param ocb: connection object
+    :type ocb: OCBase.OCBase
+    :param vpc_to_delete: vpc id to delete
+    :type vpc_to_delete: str
+    :param journal: teardown journal
+    :type journal: osc_cloud_builder.tools.journal.Journal
+    """
     for peer in ocb.fcu.get_all_vpc_peering_connections(filters={'requester-vpc-info.vpc-id': vpc_to_delete}):
         peer.delete()
+        journal.deleted('vpc_peering_connection', peer.id)
 
-    # Release EIPs
-    for instance in vpc_instances:
-        addresses = ocb.fcu.get_all_addresses(filters={'instance-id': instance.id})
-        for address in addresses:
-            try:
-                ocb.fcu.disassociate_address(association_id=address.association_id)
-            except EC2ResponseError as err:
-                ocb.log('Disassociate EIP error: {0}'.format(err.message), 'warning')
-            time.sleep(SLEEP_SHORT)
-            try:
-                ocb.fcu.release_address(allocation_id=address.allocation_id)
-            except EC2ResponseError as err:
-                ocb.log('Release EIP error: {0}'.format(err.message), 'warning')
-
-        time.sleep(SLEEP_SHORT)
+@traced
+def _release_eips(ocb, vpc_to_delete, journal):
+    """
+    Release EIPs of VPC instances
+    :param ocb: connection object
+    :type ocb: OCBase.OCBase
+    :param vpc_to_delete: vpc id to delete
+    :type vpc_to_delete: str
+    :param journal: teardown journal
+    :type journal: osc_cloud_builder.tools.journal.Journal
+    :return: False when an EIP can not be released
+    :rtype: bool
+    """
+    released = True
+    for instance_id in journal.step_data('discover_instances')['instance_ids']:
+        for address in ocb.fcu.get_all_addresses(filters={'instance-id': instance_id}):
+            if release_address(ocb, address.allocation_id):
+                journal.deleted('eip', address.allocation_id)
+            else:
+                released = False
+    return released
 
-    # Flush all nic
+@traced
+def _delete_nics(ocb, vpc_to_delete, journal):
+    """
+    Flush all nic
+    :param ocb: connection object
+    :type ocb: OCBase.OCBase
+    :param vpc_to_delete: vpc id to delete
+    :type vpc_to_delete: str
+    :param journal: teardown journal
+    :type journal: osc_cloud_builder.tools.journal.Journal
+    """
     for nic in ocb.fcu.get_all_network_interfaces(filters={'vpc-id': vpc_to_delete}):
         nic.delete()
+        journal.deleted('network_interface', nic.id)
 
-
-    # Delete internet gateways
+@traced
+def _delete_internet_gateways(ocb, vpc_to_delete, journal):
+    """
+    Detach and delete internet gateways
+    :param ocb: connection object
+    :type ocb: OCBase.OCBase
+    :param vpc_to_delete: vpc id to delete
+    :type vpc_to_delete: str
+    :param journal: teardown journal
+    :type journal: osc_cloud_builder.tools.journal.Journal
+    """
     for gw in ocb.fcu.get_all_internet_gateways(filters={'attachment.vpc-id': vpc_to_delete}):
         for attachment in gw.attachments:
             ocb.fcu.detach_internet_gateway(gw.id, attachment.vpc_id)
             time.sleep(SLEEP_SHORT)
         ocb.fcu.delete_internet_gateway(gw.id)
+        journal.deleted('internet_gateway', gw.id)
 
     time.sleep(SLEEP_SHORT)
 
+@traced
+def _delete_nat_gateways(ocb, vpc_to_delete, journal):
+    """
+    Delete nat gateways
+    :param ocb: connection object
+    :type ocb: OCBase.OCBase
+    :param vpc_to_delete: vpc id to delete
+    :type vpc_to_delete: str
+    :param journal: teardown journal
+    :type journal: osc_cloud_builder.tools.journal.Journal
+    :return: False when nat gateways can not be deleted
+    :rtype: bool
+    """
     try:
-        # Delete nat gateways
         # get_object is not able to manage a collection, so using subnet-id as differentiating
         ocb.fcu.APIVersion = '2016-11-15'
         for msubnet in ocb.fcu.get_all_subnets(filters={'vpc-id': vpc_to_delete}):
@@ -106,21 +207,44 @@ def teardown(vpc_to_delete, terminate_instances=False):
             if hasattr(nat_gateway, 'natGatewayId'):
                 ocb.fcu.make_request('DeleteNatGateway', params={'NatGatewayId': nat_gateway.natGatewayId})
                 ocb.log('Deleting natGateway {0}'.format(nat_gateway.natGatewayId), 'info')
+                journal.deleted('nat_gateway', nat_gateway.natGatewayId)
     except Exception as err:
-        ocb.log('Can not delete natgateway because: {0}'.format(err.message), 'warning')
+        ocb.log('Can not delete natgateway because: {0}'.format(err), 'warning')
+        return False
+    return True
 
-    # Delete routes
+@traced
+def _delete_routes(ocb, vpc_to_delete, journal):
+    """
+    Delete non local routes
+    :param ocb: connection object
+    :type ocb: OCBase.OCBase
+    :param vpc_to_delete: vpc id to delete
+    :type vpc_to_delete: str
+    :param journal: teardown journal
+    :type journal: osc_cloud_builder.tools.journal.Journal
+    """
     for rt in ocb.fcu.get_all_route_tables(filters={'vpc-id': vpc_to_delete}):
         for route in rt.routes:
             if route.gateway_id != 'local':
                 ocb.fcu.delete_route(rt.id, route.destination_cidr_block)
 
-
-    # Delete Load Balancers
+@traced
+def _delete_load_balancers(ocb, vpc_to_delete, journal):
+    """
+    Delete Load Balancers in the VPC subnets and wait for them to disapear
+    :param ocb: connection object
+    :type ocb: OCBase.OCBase
+    :param vpc_to_delete: vpc id to delete
+    :type vpc_to_delete: str
+    :param journal: teardown journal
+    :type journal: osc_cloud_builder.tools.journal.Journal
+    """
     if ocb.lbu:
         subnets = set([sub.id for sub in ocb.fcu.get_all_subnets(filters={'vpc-id': vpc_to_delete})])
         for lb in [lb for lb in ocb.lbu.get_all_load_balancers() if set(lb.subnets).intersection(subnets)]:
             lb.delete()
+            journal.deleted('load_balancer', lb.name)
             time.sleep(SLEEP_SHORT)
 
         # Wait for load balancers to disapear
@@ -130,6 +254,17 @@ def teardown(vpc_to_delete, terminate_instances=False):
                 break
             time.sleep(SLEEP_SHORT)
 
+@traced
+def _delete_route_tables_and_subnets(ocb, vpc_to_delete, journal):
+    """
+    Delete route tables and subnets
+    :param ocb: connection object
+    :type ocb: OCBase.OCBase
+    :param vpc_to_delete: vpc id to delete
+    :type vpc_to_delete: str
+    :param journal: teardown journal
+    :type journal: osc_cloud_builder.tools.journal.Journal
+    """
     for vpc in ocb.fcu.get_all_vpcs([vpc_to_delete]):
         # Delete route tables
         for route_table in ocb.fcu.get_all_route_tables(filters={'vpc-id': vpc.id}):
@@ -140,15 +275,30 @@ def teardown(vpc_to_delete, terminate_instances=False):
                             in ocb.fcu.get_all_route_tables(filters={'vpc-id': vpc.id})
                             if len([association for association in route_table.associations if association.main]) == 0]:
             ocb.fcu.delete_route_table(route_table.id)
+            journal.deleted('route_table', route_table.id)
 
         # Delete subnets
         for subnet in ocb.fcu.get_all_subnets(filters={'vpc-id': vpc.id}):
             ocb.fcu.delete_subnet(subnet.id)
+            journal.deleted('subnet', subnet.id)
 
     time.sleep(SLEEP_SHORT)
 
+@traced
+def _delete_security_groups(ocb, vpc_to_delete, journal):
+    """
+    Flush all rules and delete Security Groups
+    :param ocb: connection object
+    :type ocb: OCBase.OCBase
+    :param vpc_to_delete: vpc id to delete
+    :type vpc_to_delete: str
+    :param journal: teardown journal
+    :type journal: osc_cloud_builder.tools.journal.Journal
+    :return: False when a Security Group can not be deleted
+    :rtype: bool
+    """
     # Flush all rules
-    for group in ocb.fcu.get_all_security_groups(filters={'vpc-id': vpc.id}):
+    for group in ocb.fcu.get_all_security_groups(filters={'vpc-id': vpc_to_delete}):
         for rule in group.rules:
             for grant in rule.grants:
                 ocb.fcu.revoke_security_group(group_id=group.id, ip_protocol=rule.ip_protocol, from_port=rule.from_port, to_port=rule.to_port, src_security_group_group_id=grant.group_id, cidr_ip=grant.cidr_ip)
@@ -157,16 +307,226 @@ def teardown(vpc_to_delete, terminate_instances=False):
                     ocb.fcu.revoke_security_group_egress(group.id, rule.ip_protocol, rule.from_port, rule.to_port, grant.group_id, grant.cidr_ip)
 
     # Delete Security Groups
-    for sg in ocb.fcu.get_all_security_groups(filters={'vpc-id': vpc.id}):
+    deleted = True
+    for sg in ocb.fcu.get_all_security_groups(filters={'vpc-id': vpc_to_delete}):
         if 'default' not in sg.name:
             try:
                 ocb.fcu.delete_security_group(group_id=sg.id)
+                journal.deleted('security_group', sg.id)
             except EC2ResponseError as err:
                 ocb.log('Can not delete Security Group: {0}'.format(err.message), 'warning')
+                deleted = False
+    return deleted
 
-
-    # Delete VPC
+@traced
+def _delete_vpc(ocb, vpc_to_delete, journal):
+    """
+    Delete VPC
+    :param ocb: connection object
+    :type ocb: OCBase.OCBase
+    :param vpc_to_delete: vpc id to delete
+    :type vpc_to_delete: str
+    :param journal: teardown journal
+    :type journal: osc_cloud_builder.tools.journal.Journal
+    :return: False when the VPC can not be deleted
+    :rtype: bool
+    """
     try:
-        ocb.fcu.delete_vpc(vpc.id)
+        ocb.fcu.delete_vpc(vpc_to_delete)
+        journal.deleted('vpc', vpc_to_delete)
     except EC2ResponseError as err:
         ocb.log('Can not delete VPC: {0}'.format(err.message), 'error')
+        return False
+    return True
+
+
+TEARDOWN_PHASES = [
+    ('terminate_instances', _terminate_instances),
+    ('delete_vpc_peerings', _delete_vpc_peerings),
+    ('release_eips', _release_eips),
+    ('delete_nics', _delete_nics),
+    ('delete_internet_gateways', _delete_internet_gateways),
+    ('delete_nat_gateways', _delete_nat_gateways),
+    ('delete_routes', _delete_routes),
+    ('delete_load_balancers', _delete_load_balancers),
+    ('delete_route_tables_and_subnets', _delete_route_tables_and_subnets),
+    ('delete_security_groups', _delete_security_groups),
+    ('delete_vpc', _delete_vpc),
+]
+
+@traced
+def teardown(vpc_to_delete, terminate_instances=False, journal_path=None):
+    """
+    Clean all ressouces attached to the vpc_to_delete
+    When journal_path is set, completed phases are journaled and a run with the
+    same journal_path runs again the phases which failed or were not reached.
+    :param vpc_to_delete: vpc id to delete
+    :type vpc_to_delete: str
+    :param terminate_instances: continue teardown even if instances exists in the VPC
+    :type terminate_instances: bool
+    :param journal_path: journal file used to resume the teardown
+    :type journal_path: str
+    :return: True when every phase completed
+    :rtype: bool
+    """
+    ocb = OCBase()
+    journal = Journal(journal_path)
+
+    if not journal.is_done('discover_instances'):
+        if terminate_instances is False and \
+           ocb.fcu.get_only_instances(filters={'vpc-id': vpc_to_delete, 'instance-state-name': 'running'}) and \
+           ocb.fcu.get_only_instances(filters={'vpc-id': vpc_to_delete, 'instance-state-name': 'stopped'}) :
+            ocb.log('Instances are still exists in {0}, teardown will not be executed'.format(vpc_to_delete) ,'error')
+            return False
+
+        ocb.log('Deleting VPC {0}'.format(vpc_to_delete), 'info', __file__)
+        vpc_instances = ocb.fcu.get_only_instances(filters={'vpc-id': vpc_to_delete})
+        journal.checkpoint('discover_instances', vpc_id=vpc_to_delete, instance_ids=[instance.id for instance in vpc_instances])
+
+    completed = True
+    for phase_name, phase in TEARDOWN_PHASES:
+        if journal.is_done(phase_name):
+            ocb.log('Teardown of {0}: {1} already done'.format(vpc_to_delete, phase_name), 'info')
+            continue
+        # Phases which log their errors return False, they are not checkpointed so a resume runs them again
+        if phase(ocb, vpc_to_delete, journal) is False:
+            ocb.log('Teardown of {0}: {1} failed'.format(vpc_to_delete, phase_name), 'warning')
+            completed = False
+            continue
+        journal.checkpoint(phase_name)
+    return completed
+
+@traced
+def _delete_indexed_resources(ocb, vpc_to_delete, index, journal):
+    """
+    Delete the tagged internet gateways, route tables, subnets and security
+    groups of the VPC straight from the index, then the VPC
+    :param ocb: connection object
+    :type ocb: OCBase.OCBase
+    :param vpc_to_delete: vpc id to delete
+    :type vpc_to_delete: str
+    :param index: index of the tagged resources
+    :type index: osc_cloud_builder.tools.tag_index.TagIndex
+    :param journal: teardown journal
+    :type journal: osc_cloud_builder.tools.journal.Journal
+    :return: False when a resource or the VPC can not be deleted
+    :rtype: bool
+    """
+    def delete(res_type, res_id, func, *args, **kwargs):
+        try:
+            func(*args, **kwargs)
+            journal.deleted(res_type, res_id)
+            return True
+        except EC2ResponseError as err:
+            ocb.log('Can not delete {0} {1}: {2}'.format(res_type, res_id, err.message), 'warning')
+            return False
+
+    deleted = True
+    for gw in index.resources(vpc_to_delete, 'internet-gateway'):
+        deleted = delete('internet_gateway_attachment', gw.id, ocb.fcu.detach_internet_gateway, gw.id, vpc_to_delete) and deleted
+        deleted = delete('internet_gateway', gw.id, ocb.fcu.delete_internet_gateway, gw.id) and deleted
+
+    for route_table in index.resources(vpc_to_delete, 'route-table'):
+        # The main route table is deleted with the VPC
+        if [association for association in route_table.associations if association.main]:
+            continue
+        for association in route_table.associations:
+            deleted = delete('route_table_association', association.id, ocb.fcu.disassociate_route_table, association.id) and deleted
+        deleted = delete('route_table', route_table.id, ocb.fcu.delete_route_table, route_table.id) and deleted
+
+    for subnet in index.resources(vpc_to_delete, 'subnet'):
+        deleted = delete('subnet', subnet.id, ocb.fcu.delete_subnet, subnet.id) and deleted
+
+    # Security groups reference each other, flush all rules before deleting them
+    groups = index.resources(vpc_to_delete, 'security-group')
+    for group in groups:
+        try:
+            for rule in group.rules:
+                for grant in rule.grants:
+                    ocb.fcu.revoke_security_group(group_id=group.id, ip_protocol=rule.ip_protocol, from_port=rule.from_port, to_port=rule.to_port, src_security_group_group_id=grant.group_id, cidr_ip=grant.cidr_ip)
+            for rule in group.rules_egress:
+                for grant in rule.grants:
+                    ocb.fcu.revoke_security_group_egress(group.id, rule.ip_protocol, rule.from_port, rule.to_port, grant.group_id, grant.cidr_ip)
+        except EC2ResponseError as err:
+            ocb.log('Can not flush rules of security_group {0}: {1}'.format(group.id, err.message), 'warning')
+    for group in groups:
+        deleted = delete('security_group', group.id, ocb.fcu.delete_security_group, group_id=group.id) and deleted
+
+    return deleted and _delete_vpc(ocb, vpc_to_delete, journal)
+
+
+# Phases of teardown() kept by teardown_by_prefix, for the resources setup_vpc
+# does not tag and for instances, which have to be stopped and waited for
+UNTAGGED_PHASES = [
+    ('terminate_instances', _terminate_instances),
+    ('delete_vpc_peerings', _delete_vpc_peerings),
+    ('release_eips', _release_eips),
+    ('delete_nics', _delete_nics),
+    ('delete_nat_gateways', _delete_nat_gateways),
+    ('delete_routes', _delete_routes),
+    ('delete_load_balancers', _delete_load_balancers),
+]
+
+@traced
+def teardown_by_prefix(tag_prefix):
+    """
+    Clean all ressources tagged by a setup_vpc run with tag_prefix, including
+    instances and internet gateways outside VPCs and the EIPs of the bouncer
+    and of the nat gateway. In each VPC, tagged resources are deleted from the
+    index and only the untagged ones are walked; a VPC which still holds
+    resources afterwards is walked by teardown().
+    :param tag_prefix: prefix given to setup_vpc
+    :type tag_prefix: str
+    :return: index of the resources found
+    :rtype: osc_cloud_builder.tools.tag_index.TagIndex
+    :raises OCBError: When tag_prefix is empty
+    """
+    ocb = OCBase()
+    index = TagIndex(ocb).build(tag_prefix)
+    vpc_ids = index.vpcs()
+
+    # EIPs are not tagged, collect them before their instance and nat gateway are deleted
+    filters = []
+    if index.public_ips:
+        filters.append({'public-ip': list(index.public_ips)})
+    ocb.fcu.APIVersion = '2016-11-15'
+    for vpc_id in vpc_ids:
+        # setup_vpc creates one nat gateway per VPC
+        nat_gateway = ocb.fcu.get_object('DescribeNatGateways', {'Filter.1.Name': 'vpc-id', 'Filter.1.Value.1': vpc_id}, EC2Object)
+        if hasattr(nat_gateway, 'allocationId'):
+            filters.append({'allocation-id': nat_gateway.allocationId})
+    allocation_ids = set(address.allocation_id for address_filters in filters
+                         for address in ocb.fcu.get_all_addresses(filters=address_filters))
+
+    # Untagged instances are terminated too
+    instance_ids = dict((vpc_id, []) for vpc_id in vpc_ids)
+    if vpc_ids:
+        for instance in ocb.fcu.get_only_instances(filters={'vpc-id': vpc_ids}):
+            instance_ids[instance.vpc_id].append(instance.id)
+
+    for vpc_id in vpc_ids:
+        ocb.log('Deleting VPC {0}'.format(vpc_id), 'info', __file__)
+        journal = Journal()
+        journal.checkpoint('discover_instances', vpc_id=vpc_id, instance_ids=instance_ids[vpc_id])
+        for phase_name, phase in UNTAGGED_PHASES:
+            if phase(ocb, vpc_id, journal) is False:
+                ocb.log('Teardown of {0}: {1} failed'.format(vpc_id, phase_name), 'warning')
+        if not _delete_indexed_resources(ocb, vpc_id, index, journal):
+            ocb.log('VPC {0} still holds resources, walking it'.format(vpc_id), 'warning')
+            teardown(vpc_id, terminate_instances=True)
+
+    orphans = index.orphans()
+    if orphans.get('instance'):
+        try:
+            ocb.fcu.terminate_instances(orphans['instance'])
+        except EC2ResponseError as err:
+            ocb.log('Terminate instance error: {0}'.format(err.message), 'warning')
+    for gw_id in orphans.get('internet-gateway', []):
+        try:
+            ocb.fcu.delete_internet_gateway(gw_id)
+        except EC2ResponseError as err:
+            ocb.log('Can not delete internet gateway {0}: {1}'.format(gw_id, err.message), 'warning')
+
+    for allocation_id in allocation_ids:
+        release_address(ocb, allocation_id)
+    return index
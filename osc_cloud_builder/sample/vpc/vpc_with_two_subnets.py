@@ -19,11 +19,16 @@ import time
 import urllib2
 import json
 from boto.ec2.ec2object import EC2Object
+from boto.exception import EC2ResponseError
 from osc_cloud_builder.OCBase import OCBase, SLEEP_SHORT
 from osc_cloud_builder.tools.wait_for import wait_state
+from osc_cloud_builder.tools.journal import Journal
+from osc_cloud_builder.tools.tracer import traced
+from osc_cloud_builder.sample.vpc.vpc_teardown import release_address
 
 
-def _create_network(ocb, vpc_cidr, subnet_public_cidr, subnet_private_cidr, tag_prefix):
+@traced
+def _create_network(ocb, vpc_cidr, subnet_public_cidr, subnet_private_cidr, tag_prefix, journal):
     """
     Create all networks
     :param ocb: connection object
@@ -36,15 +41,20 @@ def _create_network(ocb, vpc_cidr, subnet_public_cidr, subnet_private_cidr, tag_
     :type subnet_private_cidr: str
     :param tag_prefix: prefix to be applied on all tags
     :type tag_prefix: str
+    :param journal: journal of created resources
+    :type journal: osc_cloud_builder.tools.journal.Journal
     :returns: Networks objects
     :rtype: boto.vpc.vpc.VPC, boto.vpc.vpc.SUBNET, boto.vpc.vpc.SUBNET
     """
     vpc = ocb.fcu.create_vpc(vpc_cidr)
+    journal.created('vpc', vpc.id)
     ocb.log('VPC {0} created'.format(vpc.id), level='info')
     time.sleep(SLEEP_SHORT)
     subnet_public = ocb.fcu.create_subnet(vpc.id, subnet_public_cidr)
+    journal.created('subnet', subnet_public.id)
     ocb.log('Subnet Public {0} created'.format(subnet_public.id), level='info')
     subnet_private = ocb.fcu.create_subnet(vpc.id, subnet_private_cidr)
+    journal.created('subnet', subnet_private.id)
     ocb.log('Subnet Private {0} created'.format(subnet_private.id), level='info')
     #
     ocb.fcu.create_tags([vpc.id], {'Name': '{0}'.format(tag_prefix)})
@@ -52,7 +62,8 @@ def _create_network(ocb, vpc_cidr, subnet_public_cidr, subnet_private_cidr, tag_
     ocb.fcu.create_tags([subnet_private.id], {'Name': '{0}-private'.format(tag_prefix)})
     return vpc, subnet_public, subnet_private
 
-def _create_gateway(ocb, vpc):
+@traced
+def _create_gateway(ocb, vpc, journal):
     """
     Create Internet Gateway.
     Create Route Table for Internet Access
@@ -61,18 +72,23 @@ def _create_gateway(ocb, vpc):
     :type ocb: OCBase.OCBase
     :param vpc: vpc
     :type vpc: boto.vpc.vpc.VPC
+    :param journal: journal of created resources
+    :type journal: osc_cloud_builder.tools.journal.Journal
     :returns: Internet Gateway
     :rtype: boto.vpc.internetgateway.InternetGateway
     """
     gw = ocb.fcu.create_internet_gateway()
+    journal.created('internet_gateway', gw.id)
     time.sleep(SLEEP_SHORT)
     ocb.fcu.attach_internet_gateway(gw.id, vpc.id)
+    journal.created('internet_gateway_attachment', gw.id, vpc_id=vpc.id)
     time.sleep(SLEEP_SHORT)
     gw = ocb.fcu.get_all_internet_gateways(gw.id)[0]
     ocb.log('Internet Gateway {0} created'.format(gw.id), level='info')
     return gw
 
-def _create_security_groups(ocb, vpc, tag_prefix):
+@traced
+def _create_security_groups(ocb, vpc, tag_prefix, journal):
     """
     Create Public and Private Security Group
     Public security group will allow inbound:
@@ -86,6 +102,8 @@ def _create_security_groups(ocb, vpc, tag_prefix):
     :type vpc: boto.vpc.vpc.VPC
     :param tag_prefix: prefix to be applied on all tags
     :type tag_prefix: str
+    :param journal: journal of created resources
+    :type journal: osc_cloud_builder.tools.journal.Journal
     :returns: Public and Private Security group
     :rtype: boto.ec2.securitygroup.SecurityGroup
     """
@@ -97,7 +115,11 @@ def _create_security_groups(ocb, vpc, tag_prefix):
     ocb.log('Public Security Group allows SSH from {0}'.format(current_location_ip), level='info')
     #
     sg_public = ocb.fcu.create_security_group('{0}-public'.format(tag_prefix), 'public security group', vpc_id=vpc.id)
+    journal.created('security_group', sg_public.id)
     sg_private = ocb.fcu.create_security_group('{0}-private'.format(tag_prefix), 'private security group', vpc_id=vpc.id)
+    journal.created('security_group', sg_private.id)
+    ocb.fcu.create_tags([sg_public.id], {'Name': '{0}-public'.format(tag_prefix)})
+    ocb.fcu.create_tags([sg_private.id], {'Name': '{0}-private'.format(tag_prefix)})
     #
     sg_public.authorize('tcp', 22, 22, current_location_ip)
     sg_public.authorize('tcp', 0, 65535, src_group=sg_private)
@@ -107,7 +129,8 @@ def _create_security_groups(ocb, vpc, tag_prefix):
     sg_private.authorize('tcp', 22, 22, src_group=sg_public)
     return sg_public, sg_private
 
-def _run_instances(ocb, omi_id, subnet_public, subnet_private, sg_public, sg_private, key_name, instance_type, tag_prefix):
+@traced
+def _run_instances(ocb, omi_id, subnet_public, subnet_private, sg_public, sg_private, key_name, instance_type, tag_prefix, journal):
     """
     Create BOUNCER instance in public subnet
     Create 1 instance in the private subnet
@@ -125,6 +148,8 @@ def _run_instances(ocb, omi_id, subnet_public, subnet_private, sg_public, sg_pri
     :type sg_private: boto.ec2.securitygroup.SecurityGroup
     :param tag_prefix: prefix to be applied on all tags
     :type tag_prefix: str
+    :param journal: journal of created resources
+    :type journal: osc_cloud_builder.tools.journal.Journal
     :returns: 2 instances
     :rtype: boto.ec2.instance
     """
@@ -135,6 +160,7 @@ def _run_instances(ocb, omi_id, subnet_public, subnet_private, sg_public, sg_pri
                                              security_group_ids=[sg_public.id],
                                              instance_type=instance_type,
                                              key_name=key_name).instances[0]
+    journal.created('instance', instance_bouncer.id)
     ocb.fcu.create_tags([instance_bouncer.id], {'Name': '{0}-bouncer'.format(tag_prefix)})
     #
     instance_private = ocb.fcu.run_instances(image_id=omi_id,
@@ -143,27 +169,34 @@ def _run_instances(ocb, omi_id, subnet_public, subnet_private, sg_public, sg_pri
                                              security_group_ids=[sg_private.id],
                                              instance_type=instance_type,
                                              key_name=key_name).instances[0]
+    journal.created('instance', instance_private.id)
     ocb.fcu.create_tags([instance_private.id], {'Name': '{0}-instance-1'.format(tag_prefix)})
     wait_state([instance_bouncer, instance_private], 'running')
     return instance_bouncer, instance_private
 
-def _create_natgateway(ocb, subnet_public):
+@traced
+def _create_natgateway(ocb, subnet_public, journal):
     """
     Create a natgateway, lease an EIP.
     :param ocb: connection object
     :type ocb: OCBase.OCBase
     :param subnet_public: subnet public
     :type subnet_public: boto.vpc.vpc.SUBNET
+    :param journal: journal of created resources
+    :type journal: osc_cloud_builder.tools.journal.Journal
     :returns: nat gateway identifier
     :rtype: str
     """
     ocb.fcu.APIVersion = '2016-11-15'
     eip = ocb.fcu.allocate_address(domain='vpc')
+    journal.created('eip', eip.allocation_id)
     nat_gw = ocb.fcu.get_object('CreateNatGateway', {'AllocationId': eip.allocation_id, 'SubnetId': subnet_public.id}, EC2Object)
+    journal.created('nat_gateway', nat_gw.natGatewayId)
     ocb.log('Creating NatGateway {0}'.format(nat_gw.natGatewayId), level='info')
     return nat_gw.natGatewayId
 
-def _configure_network_flows(ocb, vpc, subnet_public, subnet_private, gw, natgw_id, tag_prefix):
+@traced
+def _configure_network_flows(ocb, vpc, subnet_public, subnet_private, gw, natgw_id, tag_prefix, journal):
     """
     Setup MAIN ROUTE TABLE to route flows to nat_instance
     Create RouteTable for subnet_public to route flows to internet gateway
@@ -181,35 +214,127 @@ def _configure_network_flows(ocb, vpc, subnet_public, subnet_private, gw, natgw_
     :type natgw_id: str
     :param tag_prefix: prefix to be applied on all tags
     :type tag_prefix: str
+    :param journal: journal of created resources
+    :type journal: osc_cloud_builder.tools.journal.Journal
     """
     main_rt = ocb.fcu.get_all_route_tables(filters={'vpc-id': vpc.id, 'association.main': 'true'})[0]
     if natgw_id:
         ocb.fcu.create_route(main_rt.id, '0.0.0.0/0', natgw_id)
-    ocb.fcu.create_tags([main_rt.id], {'Name': 'main-'.format(tag_prefix)})
+        journal.created('route', main_rt.id, destination='0.0.0.0/0')
+    ocb.fcu.create_tags([main_rt.id], {'Name': '{0}-main'.format(tag_prefix)})
     #
     rt = ocb.fcu.create_route_table(vpc.id)
-    ocb.fcu.create_tags([rt.id], {'Name': 'second-'.format(tag_prefix)})
+    journal.created('route_table', rt.id)
+    ocb.fcu.create_tags([rt.id], {'Name': '{0}-second'.format(tag_prefix)})
     time.sleep(SLEEP_SHORT)
     ocb.log('Creating Route Table {0}'.format(rt.id), level='info')
-    ocb.fcu.associate_route_table(rt.id, subnet_public.id)
+    association_id = ocb.fcu.associate_route_table(rt.id, subnet_public.id)
+    journal.created('route_table_association', association_id)
     time.sleep(SLEEP_SHORT)
     ocb.fcu.create_route(rt.id, '0.0.0.0/0', gateway_id=gw.id)
 
-def _setup_public_ips(ocb, instance_bouncer):
+@traced
+def _setup_public_ips(ocb, instance_bouncer, journal):
     """
     Create and attach 2 publics IPs to nat and bouncer instances
     :param ocb: connection object
     :type ocb: OCBase.OCBase
     :param instance_bouncer: Bouncer Instance
     :type instance_bouncer: boto.ec2.instance
-
+    :param journal: journal of created resources
+    :type journal: osc_cloud_builder.tools.journal.Journal
     """
     public_ip = ocb.fcu.allocate_address("vpc")
+    journal.created('eip', public_ip.allocation_id)
     ocb.fcu.associate_address(instance_id=instance_bouncer.id, allocation_id=public_ip.allocation_id)
     ocb.fcu.create_tags([instance_bouncer.id], {'osc.fcu.eip.auto-attach': public_ip.public_ip})
     ocb.log('Boucner Instance {0} has got IP {1}'.format(instance_bouncer.id, public_ip.public_ip), level='info')
 
-def setup_vpc(omi_id, key_name, vpc_cidr='10.0.0.0/16', subnet_public_cidr='10.0.1.0/24', subnet_private_cidr='10.0.2.0/24', instance_type='t2.medium', tag_prefix=''):
+
+@traced
+def _rollback(ocb, journal, resources):
+    """
+    Delete resources recorded in the journal, most dependent resources first
+    :param ocb: connection object
+    :type ocb: OCBase.OCBase
+    :param journal: journal of created resources
+    :type journal: osc_cloud_builder.tools.journal.Journal
+    :param resources: journal resources to delete
+    :type resources: list
+    """
+    def ids(res_type):
+        return [resource['id'] for resource in resources if resource['type'] == res_type]
+
+    def delete(res_type, res_id, func, *args, **kwargs):
+        try:
+            func(*args, **kwargs)
+            journal.deleted(res_type, res_id)
+            ocb.log('Rollback: {0} {1} deleted'.format(res_type, res_id), level='info')
+        except EC2ResponseError as err:
+            ocb.log('Rollback: can not delete {0} {1}: {2}'.format(res_type, res_id, err.message), 'warning')
+
+    if ids('instance'):
+        try:
+            ocb.fcu.terminate_instances(ids('instance'))
+            wait_state(ocb.fcu.get_only_instances(ids('instance')), 'terminated')
+            for instance_id in ids('instance'):
+                journal.deleted('instance', instance_id)
+        except EC2ResponseError as err:
+            ocb.log('Rollback: can not terminate instances: {0}'.format(err.message), 'warning')
+
+    for resource in [resource for resource in resources if resource['type'] == 'route']:
+        delete('route', resource['id'], ocb.fcu.delete_route, resource['id'], resource['attrs']['destination'])
+
+    ocb.fcu.APIVersion = '2016-11-15'
+    for natgw_id in ids('nat_gateway'):
+        delete('nat_gateway', natgw_id, ocb.fcu.make_request, 'DeleteNatGateway', params={'NatGatewayId': natgw_id})
+
+    for allocation_id in ids('eip'):
+        # EIP of the bouncer is disassociated first, EIP of the nat gateway is released once the nat gateway is deleted
+        if release_address(ocb, allocation_id):
+            journal.deleted('eip', allocation_id)
+
+    for association_id in ids('route_table_association'):
+        delete('route_table_association', association_id, ocb.fcu.disassociate_route_table, association_id)
+    for rt_id in ids('route_table'):
+        delete('route_table', rt_id, ocb.fcu.delete_route_table, rt_id)
+
+    for resource in [resource for resource in resources if resource['type'] == 'internet_gateway_attachment']:
+        delete('internet_gateway_attachment', resource['id'], ocb.fcu.detach_internet_gateway, resource['id'], resource['attrs']['vpc_id'])
+    for gw_id in ids('internet_gateway'):
+        delete('internet_gateway', gw_id, ocb.fcu.delete_internet_gateway, gw_id)
+
+    if ids('security_group'):
+        # Security groups reference each other, flush all rules before deleting them
+        for sg_id in ids('security_group'):
+            try:
+                for group in ocb.fcu.get_all_security_groups(group_ids=[sg_id]):
+                    for rule in group.rules:
+                        for grant in rule.grants:
+                            ocb.fcu.revoke_security_group(group_id=group.id, ip_protocol=rule.ip_protocol, from_port=rule.from_port, to_port=rule.to_port, src_security_group_group_id=grant.group_id, cidr_ip=grant.cidr_ip)
+            except EC2ResponseError as err:
+                ocb.log('Rollback: can not flush rules of security_group {0}: {1}'.format(sg_id, err.message), 'warning')
+        for sg_id in ids('security_group'):
+            delete('security_group', sg_id, ocb.fcu.delete_security_group, group_id=sg_id)
+
+    for subnet_id in ids('subnet'):
+        delete('subnet', subnet_id, ocb.fcu.delete_subnet, subnet_id)
+    for vpc_id in ids('vpc'):
+        delete('vpc', vpc_id, ocb.fcu.delete_vpc, vpc_id)
+
+@traced
+def rollback_setup(journal_path):
+    """
+    Delete everything a crashed setup_vpc created, using only its journal
+    :param journal_path: journal file given to setup_vpc
+    :type journal_path: str
+    """
+    ocb = OCBase()
+    journal = Journal(journal_path)
+    _rollback(ocb, journal, journal.resources())
+
+@traced
+def setup_vpc(omi_id, key_name, vpc_cidr='10.0.0.0/16', subnet_public_cidr='10.0.1.0/24', subnet_private_cidr='10.0.2.0/24', instance_type='t2.medium', tag_prefix='', journal_path=None):
     """
     Create a VPC with 2 subnets and a nat instance
       - First subnet is public
@@ -217,6 +342,8 @@ def setup_vpc(omi_id, key_name, vpc_cidr='10.0.0.0/16', subnet_public_cidr='10.0
      - Second subnet is private
         - Instance for fun
      - A Nat Gateway attached to the public subnet
+    When journal_path is set, created resources and completed steps are journaled
+    and a run with the same journal_path resumes from the last completed step.
     :param omi_id: OMI identified
     :type omi_id: str
     :param key_name: key pair name
@@ -229,15 +356,60 @@ def setup_vpc(omi_id, key_name, vpc_cidr='10.0.0.0/16', subnet_public_cidr='10.0
     :type subnet_private_cidr: str
     :param tag_prefix: prefix to be applied on all tags
     :type tag_prefix: str
+    :param journal_path: journal file used to resume or rollback the setup
+    :type journal_path: str
     """
     ocb = OCBase()
-    vpc, subnet_public, subnet_private = _create_network(ocb, vpc_cidr, subnet_public_cidr, subnet_private_cidr, tag_prefix)
-    gw = _create_gateway(ocb, vpc)
-    sg_public, sg_private = _create_security_groups(ocb, vpc, tag_prefix)
-    instance_bouncer, instance_private = _run_instances(ocb, omi_id, subnet_public, subnet_private, sg_public, sg_private, key_name, instance_type, tag_prefix)
-    natgw_id = _create_natgateway(ocb, subnet_public)
-    _configure_network_flows(ocb, vpc, subnet_public, subnet_private, gw, natgw_id, tag_prefix)
-    _setup_public_ips(ocb, instance_bouncer)
+    journal = Journal(journal_path)
+    if journal.resources(since_checkpoint=True):
+        ocb.log('Resuming setup, cleaning resources of the interrupted step', level='info')
+        _rollback(ocb, journal, journal.resources(since_checkpoint=True))
+
+    if journal.is_done('create_network'):
+        data = journal.step_data('create_network')
+        vpc = ocb.fcu.get_all_vpcs([data['vpc']])[0]
+        subnets = dict((subnet.id, subnet) for subnet in ocb.fcu.get_all_subnets([data['subnet_public'], data['subnet_private']]))
+        subnet_public, subnet_private = subnets[data['subnet_public']], subnets[data['subnet_private']]
+    else:
+        vpc, subnet_public, subnet_private = _create_network(ocb, vpc_cidr, subnet_public_cidr, subnet_private_cidr, tag_prefix, journal)
+        journal.checkpoint('create_network', vpc=vpc.id, subnet_public=subnet_public.id, subnet_private=subnet_private.id)
+
+    if journal.is_done('create_gateway'):
+        gw = ocb.fcu.get_all_internet_gateways([journal.step_data('create_gateway')['gw']])[0]
+    else:
+        gw = _create_gateway(ocb, vpc, journal)
+        journal.checkpoint('create_gateway', gw=gw.id)
+
+    if journal.is_done('create_security_groups'):
+        data = journal.step_data('create_security_groups')
+        groups = dict((group.id, group) for group in ocb.fcu.get_all_security_groups(group_ids=[data['sg_public'], data['sg_private']]))
+        sg_public, sg_private = groups[data['sg_public']], groups[data['sg_private']]
+    else:
+        sg_public, sg_private = _create_security_groups(ocb, vpc, tag_prefix, journal)
+        journal.checkpoint('create_security_groups', sg_public=sg_public.id, sg_private=sg_private.id)
+
+    if journal.is_done('run_instances'):
+        data = journal.step_data('run_instances')
+        instances = dict((instance.id, instance) for instance in ocb.fcu.get_only_instances([data['instance_bouncer'], data['instance_private']]))
+        instance_bouncer, instance_private = instances[data['instance_bouncer']], instances[data['instance_private']]
+    else:
+        instance_bouncer, instance_private = _run_instances(ocb, omi_id, subnet_public, subnet_private, sg_public, sg_private, key_name, instance_type, tag_prefix, journal)
+        journal.checkpoint('run_instances', instance_bouncer=instance_bouncer.id, instance_private=instance_private.id)
+
+    if journal.is_done('create_natgateway'):
+        natgw_id = journal.step_data('create_natgateway')['natgw_id']
+    else:
+        natgw_id = _create_natgateway(ocb, subnet_public, journal)
+        journal.checkpoint('create_natgateway', natgw_id=natgw_id)
+
+    if not journal.is_done('configure_network_flows'):
+        _configure_network_flows(ocb, vpc, subnet_public, subnet_private, gw, natgw_id, tag_prefix, journal)
+        journal.checkpoint('configure_network_flows')
+
+    if not journal.is_done('setup_public_ips'):
+        _setup_public_ips(ocb, instance_bouncer, journal)
+        journal.checkpoint('setup_public_ips')
+
     instance_bouncer.update()
     instance_private.update()
     return vpc, instance_bouncer, instance_private
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark fast_parser against boto SAX parser on large synthetic responses.
+Both sides parse the response and read the identifier and Name tag of each record.
+    python -m osc_cloud_builder.tools.bench_fast_parser [count]
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import sys
+import time
+import xml.sax
+from io import BytesIO
+import boto.handler
+from boto.resultset import ResultSet
+from boto.ec2.instance import Reservation
+from boto.ec2.image import Image
+from boto.ec2.securitygroup import SecurityGroup
+from osc_cloud_builder.tools.fast_parser import iter_records
+
+NAMESPACE = 'http://ec2.amazonaws.com/doc/2016-11-15/'
+
+INSTANCE = """<item><instanceId>i-{0:08x}</instanceId><imageId>ami-2472c655</imageId>
+<instanceState><code>16</code><name>running</name></instanceState>
+<privateDnsName>ip-10-0-{1}-{2}.eu-west-2.compute.internal</privateDnsName><dnsName/>
+<reason/><keyName>test_key</keyName><amiLaunchIndex>0</amiLaunchIndex><productCodes/>
+<instanceType>t2.medium</instanceType><launchTime>2016-11-15T10:00:00.000Z</launchTime>
+<placement><availabilityZone>eu-west-2a</availabilityZone><groupName/><tenancy>default</tenancy></placement>
+<monitoring><state>disabled</state></monitoring><subnetId>subnet-0000abcd</subnetId><vpcId>vpc-0000abcd</vpcId>
+<privateIpAddress>10.0.{1}.{2}</privateIpAddress><sourceDestCheck>true</sourceDestCheck>
+<groupSet><item><groupId>sg-0000abcd</groupId><groupName>test-private</groupName></item></groupSet>
+<architecture>x86_64</architecture><rootDeviceType>ebs</rootDeviceType><rootDeviceName>/dev/sda1</rootDeviceName>
+<blockDeviceMapping><item><deviceName>/dev/sda1</deviceName><ebs><volumeId>vol-{0:08x}</volumeId><status>attached</status>
+<attachTime>2016-11-15T10:00:00.000Z</attachTime><deleteOnTermination>true</deleteOnTermination></ebs></item></blockDeviceMapping>
+<virtualizationType>hvm</virtualizationType><clientToken/>
+<tagSet><item><key>Name</key><value>test-instance-{0}</value></item><item><key>env</key><value>bench</value></item></tagSet>
+<hypervisor>xen</hypervisor><networkInterfaceSet/><ebsOptimized>false</ebsOptimized></item>"""
+
+IMAGE = """<item><imageId>ami-{0:08x}</imageId><imageLocation>outscale/centos-7-{0}</imageLocation>
+<imageState>available</imageState><imageOwnerId>123456789012</imageOwnerId><isPublic>true</isPublic>
+<architecture>x86_64</architecture><imageType>machine</imageType><imageOwnerAlias>Outscale</imageOwnerAlias>
+<name>centos-7-{0}</name><description>CentOS 7 image {0}</description><rootDeviceType>ebs</rootDeviceType>
+<rootDeviceName>/dev/sda1</rootDeviceName><blockDeviceMapping><item><deviceName>/dev/sda1</deviceName>
+<ebs><snapshotId>snap-{0:08x}</snapshotId><volumeSize>10</volumeSize><deleteOnTermination>true</deleteOnTermination>
+<volumeType>standard</volumeType></ebs></item></blockDeviceMapping><virtualizationType>hvm</virtualizationType>
+<creationDate>2016-11-15T10:00:00.000Z</creationDate><tagSet/><hypervisor>xen</hypervisor></item>"""
+
+SECURITY_GROUP = """<item><ownerId>123456789012</ownerId><groupId>sg-{0:08x}</groupId><groupName>test-{0}</groupName>
+<groupDescription>bench security group</groupDescription><vpcId>vpc-0000abcd</vpcId>
+<ipPermissions><item><ipProtocol>tcp</ipProtocol><fromPort>22</fromPort><toPort>22</toPort><groups/>
+<ipRanges><item><cidrIp>10.0.0.0/16</cidrIp></item></ipRanges></item>
+<item><ipProtocol>tcp</ipProtocol><fromPort>0</fromPort><toPort>65535</toPort>
+<groups><item><userId>123456789012</userId><groupId>sg-0000abcd</groupId></item></groups><ipRanges/></item></ipPermissions>
+<ipPermissionsEgress><item><ipProtocol>-1</ipProtocol><groups/><ipRanges><item><cidrIp>0.0.0.0/0</cidrIp></item></ipRanges></item></ipPermissionsEgress>
+<tagSet><item><key>Name</key><value>test-{0}</value></item></tagSet></item>"""
+
+
+def _instances_response(count):
+    reservations = []
+    for start in range(0, count, 10):
+        instances = ''.join(INSTANCE.format(i, i // 250 % 250, i % 250) for i in range(start, min(start + 10, count)))
+        reservations.append('<item><reservationId>r-{0:08x}</reservationId><ownerId>123456789012</ownerId>'
+                            '<groupSet/><instancesSet>{1}</instancesSet></item>'.format(start, instances))
+    return ('<DescribeInstancesResponse xmlns="{0}"><requestId>bench</requestId><reservationSet>{1}'
+            '</reservationSet></DescribeInstancesResponse>'.format(NAMESPACE, ''.join(reservations))).encode('utf-8')
+
+
+def _images_response(count):
+    return ('<DescribeImagesResponse xmlns="{0}"><requestId>bench</requestId><imagesSet>{1}'
+            '</imagesSet></DescribeImagesResponse>'.format(NAMESPACE, ''.join(IMAGE.format(i) for i in range(count)))).encode('utf-8')
+
+
+def _security_groups_response(count):
+    return ('<DescribeSecurityGroupsResponse xmlns="{0}"><requestId>bench</requestId><securityGroupInfo>{1}'
+            '</securityGroupInfo></DescribeSecurityGroupsResponse>'.format(NAMESPACE, ''.join(SECURITY_GROUP.format(i) for i in range(count)))).encode('utf-8')
+
+
+def _boto_parse(body, markers):
+    """
+    Same parsing as boto AWSQueryConnection.get_list
+    """
+    rs = ResultSet(markers)
+    xml.sax.parseString(body, boto.handler.XmlHandler(rs, None))
+    return rs
+
+
+def _best_of(func, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        timings.append(time.time() - start)
+    return min(timings), result
+
+
+def bench(count=10000):
+    """
+    Parse synthetic responses with both parsers and print timings
+    :param count: number of instances, images and security groups per response
+    :type count: int
+    """
+    cases = [
+        ('DescribeInstances', _instances_response(count), [('item', Reservation)],
+         lambda rs: [(instance.id, instance.tags.get('Name')) for reservation in rs for instance in reservation.instances],
+         lambda record: (record['instanceId'], record.tags.get('Name'))),
+        ('DescribeImages', _images_response(count), [('item', Image)],
+         lambda rs: [(image.id, image.tags.get('Name')) for image in rs],
+         lambda record: (record['imageId'], record.tags.get('Name'))),
+        ('DescribeSecurityGroups', _security_groups_response(count), [('item', SecurityGroup)],
+         lambda rs: [(group.id, group.tags.get('Name')) for group in rs],
+         lambda record: (record['groupId'], record.tags.get('Name'))),
+    ]
+    print('{0:<24} {1:>10} {2:>10} {3:>10} {4:>8}'.format('action', 'size (MB)', 'boto (s)', 'lxml (s)', 'speedup'))
+    for action, body, markers, boto_read, lxml_read in cases:
+        boto_time, boto_values = _best_of(lambda: boto_read(_boto_parse(body, markers)))
+        lxml_time, lxml_values = _best_of(lambda: [lxml_read(record) for record in iter_records(BytesIO(body), action)])
+        assert boto_values == lxml_values and len(lxml_values) == count
+        print('{0:<24} {1:>10.1f} {2:>10.3f} {3:>10.3f} {4:>7.1f}x'.format(
+            action, len(body) / 1e6, boto_time, lxml_time, boto_time / lxml_time))
+
+
+if __name__ == '__main__':
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming parser for large Describe responses.
+DescribeInstances, DescribeImages and DescribeSecurityGroups responses are
+parsed with lxml iterparse while they are read from the socket. Each instance,
+image or security group element is detached from the document as soon as it
+is parsed and wrapped in a lightweight Record: values are only extracted, in C,
+when they are read.
+
+    >>>ocb = OCBase()
+    >>>for instance in iter_instances(ocb.fcu, filters={'vpc-id': vpc_id}):
+    >>>    print instance['instanceId'], instance['instanceState/name'], instance.tags.get('Name')
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+from lxml import etree
+
+# Elements which are lists even when empty
+LIST_TAGS = ('securityGroupInfo', 'ipPermissions', 'ipPermissionsEgress', 'groups', 'ipRanges')
+
+# Element holding the records of each action
+RECORD_PARENTS = {
+    'DescribeInstances': 'instancesSet',
+    'DescribeImages': 'imagesSet',
+    'DescribeSecurityGroups': 'securityGroupInfo',
+}
+
+
+def _to_value(elem, ns_len):
+    """
+    Convert an element subtree to python values
+        - leaf elements give their text
+        - tagSet gives a dict
+        - xxxSet and item lists give a list
+        - other elements give a dict
+    :param elem: element
+    :type elem: lxml.etree._Element
+    :param ns_len: length of the namespace prefix of tags
+    :type ns_len: int
+    :return: value
+    :rtype: dict, list or str
+    """
+    tag = elem.tag[ns_len:]
+    if tag == 'tagSet':
+        # key and value are a sequence in the EC2 schema
+        return dict((item[0].text, item[1].text) for item in elem)
+    if not len(elem):
+        if tag.endswith('Set') or tag in LIST_TAGS:
+            return []
+        return elem.text
+    if tag.endswith('Set') or tag in LIST_TAGS or elem[0].tag[ns_len:] == 'item':
+        return [_to_value(child, ns_len) for child in elem]
+    return dict((child.tag[ns_len:], _to_value(child, ns_len)) for child in elem)
+
+
+class Record(object):
+    """
+    Lightweight view on a detached response element
+    """
+
+    __slots__ = ('_elem', '_namespace', 'extra')
+    _paths = {}
+
+    def __init__(self, elem, namespace, extra=None):
+        """
+        :param elem: instance, image or security group element
+        :type elem: lxml.etree._Element
+        :param namespace: '{namespace}' prefix of the response tags
+        :type namespace: str
+        :param extra: values not held by elem (reservationId, ownerId)
+        :type extra: dict
+        """
+        self._elem = elem
+        self._namespace = namespace
+        self.extra = extra or {}
+
+    def __path(self, path):
+        """
+        :return: path with namespaced steps, cached as records share few paths
+        :rtype: str
+        """
+        key = (self._namespace, path)
+        if key not in self._paths:
+            self._paths[key] = '/'.join(self._namespace + step for step in path.split('/'))
+        return self._paths[key]
+
+    def get(self, path, default=None):
+        """
+        :param path: element name or path, 'instanceId', 'instanceState/name'...
+        :type path: str
+        :return: text of a leaf element, dict or list for other elements
+        :rtype: str, dict or list
+        """
+        if path in self.extra:
+            return self.extra[path]
+        elem = self._elem.find(self.__path(path))
+        if elem is None:
+            return default
+        if not len(elem) and elem.tag[len(self._namespace):] not in LIST_TAGS and not elem.tag.endswith('Set'):
+            return elem.text
+        return _to_value(elem, len(self._namespace))
+
+    def __getitem__(self, path):
+        value = self.get(path, KeyError)
+        if value is KeyError:
+            raise KeyError(path)
+        return value
+
+    @property
+    def tags(self):
+        """
+        :return: tags
+        :rtype: dict
+        """
+        return self.get('tagSet', {})
+
+    def to_dict(self):
+        """
+        :return: the whole record converted to python values
+        :rtype: dict
+        """
+        record = _to_value(self._elem, len(self._namespace))
+        record.update(self.extra)
+        return record
+
+
+def iter_records(stream, action):
+    """
+    Parse a Describe response incrementally
+    :param stream: response body, any object with a read() method
+    :type stream: file
+    :param action: DescribeInstances, DescribeImages or DescribeSecurityGroups
+    :type action: str
+    :return: records, instances also get the reservationId and ownerId of their reservation
+    :rtype: generator
+    """
+    record_parent = RECORD_PARENTS[action]
+    namespace = None
+    for _, elem in etree.iterparse(stream, events=('end',), tag='{*}item', remove_comments=True):
+        if namespace is None:
+            namespace = elem.tag[:elem.tag.index('}') + 1] if elem.tag.startswith('{') else ''
+        parent = elem.getparent()
+        parent_tag = parent.tag[len(namespace):]
+        if parent_tag == record_parent:
+            extra = None
+            if action == 'DescribeInstances':
+                reservation = parent.getparent()
+                extra = {'reservationId': reservation.findtext(namespace + 'reservationId'),
+                         'ownerId': reservation.findtext(namespace + 'ownerId')}
+            # Detached, the element is freed with its record
+            parent.remove(elem)
+            yield Record(elem, namespace, extra)
+        elif parent_tag == 'reservationSet':
+            parent.remove(elem)
+
+
+def iter_describe(conn, action, params=None):
+    """
+    Send a Describe request and parse its response as it is received
+    :param conn: FCU connection
+    :type conn: boto.vpc.VPCConnection
+    :param action: DescribeInstances, DescribeImages or DescribeSecurityGroups
+    :type action: str
+    :param params: request parameters
+    :type params: dict
+    :return: records
+    :rtype: generator
+    :raises conn.ResponseError: When the request fails
+    """
+    response = conn.make_request(action, params or {}, verb='POST')
+    if response.status != 200:
+        raise conn.ResponseError(response.status, response.reason, response.read())
+    return iter_records(response, action)
+
+
+def iter_instances(conn, instance_ids=None, filters=None):
+    """
+    :param conn: FCU connection
+    :type conn: boto.vpc.VPCConnection
+    :param instance_ids: instance identifiers
+    :type instance_ids: list
+    :param filters: DescribeInstances filters
+    :type filters: dict
+    :return: instances
+    :rtype: generator
+    """
+    params = {}
+    if instance_ids:
+        conn.build_list_params(params, instance_ids, 'InstanceId')
+    if filters:
+        conn.build_filter_params(params, filters)
+    return iter_describe(conn, 'DescribeInstances', params)
+
+
+def iter_images(conn, image_ids=None, owners=None, filters=None):
+    """
+    :param conn: FCU connection
+    :type conn: boto.vpc.VPCConnection
+    :param image_ids: image identifiers
+    :type image_ids: list
+    :param owners: image owners
+    :type owners: list
+    :param filters: DescribeImages filters
+    :type filters: dict
+    :return: images
+    :rtype: generator
+    """
+    params = {}
+    if image_ids:
+        conn.build_list_params(params, image_ids, 'ImageId')
+    if owners:
+        conn.build_list_params(params, owners, 'Owner')
+    if filters:
+        conn.build_filter_params(params, filters)
+    return iter_describe(conn, 'DescribeImages', params)
+
+
+def iter_security_groups(conn, group_ids=None, filters=None):
+    """
+    :param conn: FCU connection
+    :type conn: boto.vpc.VPCConnection
+    :param group_ids: security group identifiers
+    :type group_ids: list
+    :param filters: DescribeSecurityGroups filters
+    :type filters: dict
+    :return: security groups
+    :rtype: generator
+    """
+    params = {}
+    if group_ids:
+        conn.build_list_params(params, group_ids, 'GroupId')
+    if filters:
+        conn.build_filter_params(params, filters)
+    return iter_describe(conn, 'DescribeSecurityGroups', params)
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Local image catalog cache.
+Image metadata is saved in a compact gzipped JSON file, refreshed on a TTL and
+indexed by name, architecture, root device type and creation date so that OMI
+lookups are answered without calling DescribeImages.
+
+    >>>cache = ImageCatalogCache()
+    >>>omi = cache.find(name=['centos-7*', 'Centos7*'], architecture='x86_64', root_device_type='ebs')[0]
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import os
+import time
+import json
+import gzip
+import bisect
+import tempfile
+from fnmatch import fnmatchcase
+from osc_cloud_builder.OCBase import OCBase
+from osc_cloud_builder.tools.fast_parser import iter_images
+
+CACHE_PATH = '~/.osc_cloud_builder/images.json.gz'
+CACHE_TTL = 3600
+RETRY_DELAY = 300
+WILDCARDS = '*?['
+
+IMAGE_FIELDS = {
+    'id': 'imageId',
+    'name': 'name',
+    'state': 'imageState',
+    'architecture': 'architecture',
+    'root_device_type': 'rootDeviceType',
+    'virtualization_type': 'virtualizationType',
+    'owner_id': 'imageOwnerId',
+    'creation_date': 'creationDate',
+}
+
+
+def _image_to_record(image):
+    """
+    Keep the cached fields of a DescribeImages record
+    :param image: image returned by DescribeImages
+    :type image: osc_cloud_builder.tools.fast_parser.Record
+    :return: image metadata
+    :rtype: dict
+    """
+    return dict((field, image.get(path) or '') for field, path in IMAGE_FIELDS.items())
+
+
+class ImageCatalogCache(object):
+    """
+    Image metadata cache stored on disk and indexed in memory
+    """
+
+    def __init__(self, cache_path=CACHE_PATH, ttl=CACHE_TTL, owners=None, filters=None, ocb=None, retry_delay=RETRY_DELAY):
+        """
+        :param cache_path: path of the cache file
+        :type cache_path: str
+        :param ttl: seconds before the catalog has to be refreshed
+        :type ttl: int
+        :param owners: owners used to scope DescribeImages on refresh
+        :type owners: list
+        :param filters: filters used to scope DescribeImages on refresh
+        :type filters: dict
+        :param ocb: connection object, OCBase() is used if not set
+        :type ocb: OCBase.OCBase
+        :param retry_delay: seconds before retrying a failed refresh, the stale catalog is served meanwhile
+        :type retry_delay: int
+        """
+        self.cache_path = os.path.expanduser(cache_path)
+        self.ttl = ttl
+        self.retry_delay = retry_delay
+        self.next_refresh_at = 0
+        self.owners = owners
+        self.filters = filters
+        self.ocb = ocb
+        self.refreshed_at = 0
+        self.images = {}
+        self.__by_attr = {}
+        self.__by_name = []
+        self.__by_date = []
+        self.load()
+
+    def load(self):
+        """
+        Load catalog from the cache file, an unreadable file gives an empty catalog
+        """
+        try:
+            with gzip.open(self.cache_path, 'rb') as cache_file:
+                content = json.loads(cache_file.read().decode('utf-8'))
+            self.refreshed_at = content['refreshed_at']
+            self.images = dict((record['id'], record) for record in content['images'])
+        except (IOError, OSError, ValueError, KeyError):
+            self.refreshed_at = 0
+            self.images = {}
+        self.__build_index()
+
+    def save(self):
+        """
+        Atomically write catalog in the cache file
+        """
+        directory = os.path.dirname(self.cache_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        content = json.dumps({'refreshed_at': self.refreshed_at, 'images': list(self.images.values())},
+                             separators=(',', ':'))
+        # One temporary file per writer, concurrent refreshes do not clobber each other
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=directory or '.', prefix='.images.', suffix='.tmp')
+        try:
+            with os.fdopen(tmp_fd, 'wb') as tmp_file:
+                with gzip.GzipFile(fileobj=tmp_file, mode='wb') as cache_file:
+                    cache_file.write(content.encode('utf-8'))
+            os.rename(tmp_path, self.cache_path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def is_stale(self):
+        """
+        :return: True when the catalog is older than the TTL
+        :rtype: bool
+        """
+        now = time.time()
+        return now - self.refreshed_at > self.ttl and now >= self.next_refresh_at
+
+    def refresh(self, force=False):
+        """
+        Refresh the catalog if stale. Fetched images replace the catalog, the index
+        is only rebuilt when images were added, changed or removed. When DescribeImages
+        fails and a catalog is cached, the error is logged and the stale catalog is served
+        without calling DescribeImages again for retry_delay seconds.
+        :param force: refresh even if the catalog is not stale
+        :type force: bool
+        :return: number of added, updated and removed images
+        :rtype: tuple
+        """
+        if not force and not self.is_stale():
+            return 0, 0, 0
+        ocb = self.ocb or OCBase()
+        try:
+            fetched = dict((record['id'], record) for record in
+                           (_image_to_record(image) for image in iter_images(ocb.fcu, owners=self.owners, filters=self.filters)))
+        except Exception as err:
+            if not self.images:
+                raise
+            self.next_refresh_at = time.time() + self.retry_delay
+            ocb.log('Image catalog refresh failed, using stale catalog for {0}s: {1}'.format(self.retry_delay, err), level='warning')
+            return 0, 0, 0
+        added = [image_id for image_id in fetched if image_id not in self.images]
+        updated = [image_id for image_id in fetched if image_id in self.images and fetched[image_id] != self.images[image_id]]
+        removed = [image_id for image_id in self.images if image_id not in fetched]
+        self.images = fetched
+        self.refreshed_at = time.time()
+        if added or updated or removed:
+            self.__build_index()
+        self.save()
+        ocb.log('Image catalog refreshed: {0} added, {1} updated, {2} removed'.format(len(added), len(updated), len(removed)), level='info')
+        return len(added), len(updated), len(removed)
+
+    def __build_index(self):
+        """
+        Build attribute, name and creation date indexes
+        """
+        self.__by_attr = {'architecture': {}, 'root_device_type': {}}
+        for image_id, record in self.images.items():
+            for attr, index in self.__by_attr.items():
+                index.setdefault(record[attr], set()).add(image_id)
+        self.__by_name = sorted((record['name'], image_id) for image_id, record in self.images.items())
+        self.__by_date = sorted((record['creation_date'], image_id) for image_id, record in self.images.items())
+
+    def __match_name(self, pattern):
+        """
+        Use the literal prefix of the pattern to only scan a slice of the sorted names
+        :param pattern: name or shell-style pattern
+        :type pattern: str
+        :return: matching image ids
+        :rtype: set
+        """
+        prefix = pattern
+        for wildcard in WILDCARDS:
+            prefix = prefix.split(wildcard, 1)[0]
+        position = bisect.bisect_left(self.__by_name, (prefix,))
+        ids = set()
+        while position < len(self.__by_name) and self.__by_name[position][0].startswith(prefix):
+            name, image_id = self.__by_name[position]
+            if fnmatchcase(name, pattern):
+                ids.add(image_id)
+            position += 1
+        return ids
+
+    def find(self, name=None, architecture=None, root_device_type=None, created_after=None, created_before=None):
+        """
+        Find images in the local catalog, refreshing it first if stale
+        :param name: name or list of shell-style patterns as for the DescribeImages name filter
+        :type name: str or list
+        :param architecture: image architecture (i386, x86_64)
+        :type architecture: str
+        :param root_device_type: root device type (ebs, instance-store)
+        :type root_device_type: str
+        :param created_after: ISO 8601 date, images created at or after
+        :type created_after: str
+        :param created_before: ISO 8601 date, images created before
+        :type created_before: str
+        :return: matching images, newest first
+        :rtype: list
+        """
+        self.refresh()
+        candidates = []
+        if name is not None:
+            patterns = name if isinstance(name, (list, tuple)) else [name]
+            candidates.append(set().union(*[self.__match_name(pattern) for pattern in patterns]))
+        for attr, value in (('architecture', architecture), ('root_device_type', root_device_type)):
+            if value is not None:
+                candidates.append(self.__by_attr[attr].get(value, set()))
+        if created_after is not None or created_before is not None:
+            start = bisect.bisect_left(self.__by_date, (created_after,)) if created_after else 0
+            end = bisect.bisect_left(self.__by_date, (created_before,)) if created_before else len(self.__by_date)
+            candidates.append(set(image_id for _, image_id in self.__by_date[start:end]))
+        if candidates:
+            ids = set.intersection(*sorted(candidates, key=len))
+        else:
+            ids = set(self.images)
+        return sorted((self.images[image_id] for image_id in ids), key=lambda record: record['creation_date'], reverse=True)
+
+    def get(self, image_id):
+        """
+        :param image_id: OMI identifier
+        :type image_id: str
+        :return: image metadata or None
+        :rtype: dict
+        """
+        self.refresh()
+        return self.images.get(image_id)
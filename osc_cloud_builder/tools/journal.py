@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only journal of created and deleted resources and of completed steps.
+Each record is a JSON line flushed to disk before the run goes on, so that an
+interrupted run can be resumed from its last checkpoint or rolled back.
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import os
+import json
+import time
+
+
+class Journal(object):
+    """
+    Resources and checkpoints journal, kept in memory only when path is None
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: journal file path
+        :type path: str
+        """
+        self.path = os.path.expanduser(path) if path else None
+        self.entries = []
+        if self.path and os.path.exists(self.path):
+            self.__load()
+
+    def __load(self):
+        """
+        Load records, skipping unreadable lines. A last line torn by a crash is
+        cut off so that the next record starts on its own line.
+        """
+        with open(self.path, 'rb') as journal_file:
+            content = journal_file.read()
+        lines = content.split(b'\n')
+        for line in lines[:-1]:
+            try:
+                self.entries.append(json.loads(line.decode('utf-8')))
+            except ValueError:
+                # Line torn by an earlier crash
+                continue
+        if lines[-1]:
+            try:
+                self.entries.append(json.loads(lines[-1].decode('utf-8')))
+                with open(self.path, 'ab') as journal_file:
+                    journal_file.write(b'\n')
+            except ValueError:
+                with open(self.path, 'rb+') as journal_file:
+                    journal_file.truncate(len(content) - len(lines[-1]))
+
+    def record(self, event, **fields):
+        """
+        Append a record to the journal
+        :param event: created, deleted or checkpoint
+        :type event: str
+        """
+        entry = dict(fields, event=event, time=time.time())
+        self.entries.append(entry)
+        if self.path:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.path, 'a') as journal_file:
+                journal_file.write('{0}\n'.format(json.dumps(entry, separators=(',', ':'))))
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+
+    def created(self, res_type, res_id, **attrs):
+        """
+        :param res_type: resource type (vpc, subnet, instance...)
+        :type res_type: str
+        :param res_id: resource identifier
+        :type res_id: str
+        """
+        self.record('created', type=res_type, id=res_id, attrs=attrs)
+
+    def deleted(self, res_type, res_id):
+        """
+        :param res_type: resource type (vpc, subnet, instance...)
+        :type res_type: str
+        :param res_id: resource identifier
+        :type res_id: str
+        """
+        self.record('deleted', type=res_type, id=res_id)
+
+    def checkpoint(self, step, **data):
+        """
+        Mark step as completed
+        :param step: step name
+        :type step: str
+        :param data: what is needed to resume after this step
+        :type data: dict
+        """
+        self.record('checkpoint', step=step, data=data)
+
+    def is_done(self, step):
+        """
+        :param step: step name
+        :type step: str
+        :return: True if step has been checkpointed
+        :rtype: bool
+        """
+        return any(entry['event'] == 'checkpoint' and entry['step'] == step for entry in self.entries)
+
+    def step_data(self, step):
+        """
+        :param step: step name
+        :type step: str
+        :return: data saved with the step checkpoint
+        :rtype: dict
+        """
+        for entry in reversed(self.entries):
+            if entry['event'] == 'checkpoint' and entry['step'] == step:
+                return entry['data']
+        return None
+
+    def resources(self, since_checkpoint=False):
+        """
+        Resources created and not deleted yet, in creation order
+        :param since_checkpoint: only resources created after the last checkpoint
+        :type since_checkpoint: bool
+        :return: dicts with type, id and attrs keys
+        :rtype: list
+        """
+        entries = self.entries
+        if since_checkpoint:
+            checkpoints = [i for i, entry in enumerate(entries) if entry['event'] == 'checkpoint']
+            if checkpoints:
+                entries = entries[checkpoints[-1] + 1:]
+        deleted = set((entry['type'], entry['id']) for entry in self.entries if entry['event'] == 'deleted')
+        return [entry for entry in entries
+                if entry['event'] == 'created' and (entry['type'], entry['id']) not in deleted]
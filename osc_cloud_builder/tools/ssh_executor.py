@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Run remote commands on many instances concurrently through a bouncer host.
+A single SSH connection is opened to the bouncer, every private instance is
+reached through a channel multiplexed over it and connections are kept open
+across commands.
+Requirements:
+    paramiko, installed with pip install osc_cloud_builder[ssh] (already installed with Fabric)
+
+    >>>with BouncerExecutor(instance_bouncer.ip_address, kp['path']) as executor:
+    >>>    results = executor.run([instance.private_ip_address for instance in instances], 'uptime')
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import time
+import threading
+import Queue
+import paramiko
+from osc_cloud_builder.OCBase import OCBase, OCBError, SLEEP_SHORT
+
+
+class BouncerExecutor(object):
+    """
+    Concurrent command executor using the bouncer as SSH gateway
+    """
+
+    def __init__(self, bouncer_address, keypair_path, user='root', max_workers=10, port=22,
+                 connection_attempts=10, timeout=120, client_factory=paramiko.SSHClient):
+        """
+        :param bouncer_address: ip or dns name of the bouncer
+        :type bouncer_address: str
+        :param keypair_path: keypair path
+        :type keypair_path: str
+        :param user: user used on the bouncer and on the instances
+        :type user: str
+        :param max_workers: maximum number of commands running at the same time
+        :type max_workers: int
+        :param port: SSH port of the bouncer and of the instances
+        :type port: int
+        :param connection_attempts: number of tries to connect to a host
+        :type connection_attempts: int
+        :param timeout: connection timeout in seconds
+        :type timeout: int
+        :param client_factory: SSH client class, paramiko.SSHClient or a local stand-in
+        :type client_factory: class
+        """
+        self.bouncer_address = bouncer_address
+        self.keypair_path = keypair_path
+        self.user = user
+        self.max_workers = max_workers
+        self.port = port
+        self.connection_attempts = connection_attempts
+        self.timeout = timeout
+        self.client_factory = client_factory
+        self.ocb = OCBase()
+        self.__bouncer = None
+        self.__clients = {}
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def from_instance(cls, instance_bouncer, keypair_path, **kwargs):
+        """
+        Build an executor from the bouncer returned by setup_vpc
+        :param instance_bouncer: Bouncer Instance
+        :type instance_bouncer: boto.ec2.instance
+        :param keypair_path: keypair path
+        :type keypair_path: str
+        :return: executor
+        :rtype: BouncerExecutor
+        """
+        return cls(instance_bouncer.ip_address, keypair_path, **kwargs)
+
+    def __connect(self, address, sock=None):
+        """
+        Open an SSH connection, retrying up to connection_attempts
+        :param address: ip or dns name of a machine
+        :type address: str
+        :param sock: channel to connect through
+        :type sock: paramiko.Channel
+        :return: connected client
+        :rtype: paramiko.SSHClient
+        :raises OCBError: When the host can not be reached
+        """
+        for attempt in range(1, self.connection_attempts + 1):
+            client = self.client_factory()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            try:
+                client.connect(address, port=self.port, username=self.user, key_filename=self.keypair_path,
+                               timeout=self.timeout, sock=sock, allow_agent=False, look_for_keys=False)
+                return client
+            except (paramiko.SSHException, EnvironmentError) as err:
+                self.ocb.log('Connection {0}/{1} to {2} failed: {3}'.format(attempt, self.connection_attempts, address, err), 'warning')
+                client.close()
+                if sock is not None:
+                    # A failed handshake consumes the channel
+                    sock = self.__open_channel(address)
+                time.sleep(SLEEP_SHORT)
+        raise OCBError('Can not connect to {0}'.format(address))
+
+    def __open_channel(self, address):
+        """
+        Open a direct-tcpip channel to address over the bouncer connection
+        :param address: ip or dns name of a machine reachable from the bouncer
+        :type address: str
+        :return: channel
+        :rtype: paramiko.Channel
+        """
+        with self.__lock:
+            if self.__bouncer is None or not self.__bouncer.get_transport() or not self.__bouncer.get_transport().is_active():
+                self.__bouncer = self.__connect(self.bouncer_address)
+                self.ocb.log('Connected to bouncer {0}'.format(self.bouncer_address), 'info')
+            transport = self.__bouncer.get_transport()
+        return transport.open_channel('direct-tcpip', (address, self.port), ('127.0.0.1', 0), timeout=self.timeout)
+
+    def __client(self, address):
+        """
+        Get the cached connection to address or open a new one through the bouncer
+        :param address: ip or dns name of a machine reachable from the bouncer
+        :type address: str
+        :return: connected client
+        :rtype: paramiko.SSHClient
+        """
+        with self.__lock:
+            client = self.__clients.get(address)
+        if client is not None and client.get_transport() and client.get_transport().is_active():
+            return client
+        client = self.__connect(address, sock=self.__open_channel(address))
+        with self.__lock:
+            self.__clients[address] = client
+        return client
+
+    def __execute(self, address, command, on_output):
+        """
+        Run command on address, streaming each output line to on_output
+        :param address: ip or dns name of a machine reachable from the bouncer
+        :type address: str
+        :param command: command to run
+        :type command: str
+        :param on_output: called with (address, line) for each output line
+        :type on_output: function
+        :return: exit status and output lines
+        :rtype: tuple
+        """
+        channel = self.__client(address).get_transport().open_session(timeout=self.timeout)
+        channel.set_combine_stderr(True)
+        channel.exec_command(command)
+        lines = []
+        for line in channel.makefile('r'):
+            line = line.rstrip('\n')
+            lines.append(line)
+            on_output(address, line)
+        status = channel.recv_exit_status()
+        channel.close()
+        return status, lines
+
+    def run(self, addresses, command, on_output=None):
+        """
+        Run command on all addresses, at most max_workers at a time
+        :param addresses: ip or dns names of machines reachable from the bouncer
+        :type addresses: list
+        :param command: command to run
+        :type command: str
+        :param on_output: called with (address, line) for each output line, log by default
+        :type on_output: function
+        :return: (exit status, output lines) by address, exit status is None and output is the error on failure
+        :rtype: dict
+        """
+        if on_output is None:
+            on_output = lambda address, line: self.ocb.log('[{0}] {1}'.format(address, line), 'info')
+        pending = Queue.Queue()
+        for address in set(addresses):
+            pending.put(address)
+        results = {}
+
+        def worker():
+            while True:
+                try:
+                    address = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[address] = self.__execute(address, command, on_output)
+                except Exception as err:
+                    self.ocb.log('Command on {0} failed: {1}'.format(address, err), 'error')
+                    results[address] = (None, [str(err)])
+
+        workers = [threading.Thread(target=worker) for _ in range(min(self.max_workers, pending.qsize()))]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+        for thread in workers:
+            thread.join()
+        return results
+
+    def close(self):
+        """
+        Close instance connections then the bouncer connection
+        """
+        with self.__lock:
+            for client in self.__clients.values():
+                client.close()
+            self.__clients = {}
+            if self.__bouncer is not None:
+                self.__bouncer.close()
+                self.__bouncer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
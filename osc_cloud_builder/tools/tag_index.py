@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Tag-indexed resource discovery.
+Resources whose Name tag starts with a prefix are found with paginated
+DescribeTags calls, then grouped by VPC with a single Describe call per
+resource type. Resources outside any VPC (instances out of a VPC, detached
+internet gateways) are the orphans of the index.
+
+    >>>index = TagIndex().build('test-connect-to-instance')
+    >>>print index.vpcs(), index.resources(index.vpcs()[0], 'subnet'), index.orphans()
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+from boto.ec2.tag import Tag
+from osc_cloud_builder.OCBase import OCBase, OCBError
+
+PAGE_SIZE = 1000
+EIP_TAG = 'osc.fcu.eip.auto-attach'
+# DescribeTags resource type: (describe method, id filter)
+DESCRIBE = {
+    'vpc': ('get_all_vpcs', 'vpc-id'),
+    'subnet': ('get_all_subnets', 'subnet-id'),
+    'route-table': ('get_all_route_tables', 'route-table-id'),
+    'security-group': ('get_all_security_groups', 'group-id'),
+    'internet-gateway': ('get_all_internet_gateways', 'internet-gateway-id'),
+    'instance': ('get_only_instances', 'instance-id'),
+}
+
+
+class TagIndex(object):
+    """
+    Index of tagged resources by VPC and type
+    """
+
+    def __init__(self, ocb=None):
+        """
+        :param ocb: connection object, OCBase() is used if not set
+        :type ocb: OCBase.OCBase
+        """
+        self.ocb = ocb or OCBase()
+        self.by_vpc = {}
+        self.public_ips = set()
+
+    def describe_tags(self, filters):
+        """
+        DescribeTags following NextToken
+        :param filters: DescribeTags filters
+        :type filters: dict
+        :return: tags
+        :rtype: list
+        """
+        tags = []
+        next_token = None
+        while True:
+            params = {'MaxResults': PAGE_SIZE}
+            self.ocb.fcu.build_filter_params(params, filters)
+            if next_token:
+                params['NextToken'] = next_token
+            page = self.ocb.fcu.get_list('DescribeTags', params, [('item', Tag)], verb='POST')
+            tags.extend(page)
+            next_token = page.next_token
+            if not next_token:
+                return tags
+
+    def build(self, tag_prefix):
+        """
+        Index resources whose Name tag starts with tag_prefix
+        :param tag_prefix: prefix given to setup_vpc
+        :type tag_prefix: str
+        :return: self
+        :rtype: TagIndex
+        :raises OCBError: When tag_prefix is empty, it would match every Name tag of the account
+        """
+        if not tag_prefix:
+            raise OCBError('An empty tag prefix matches every named resource')
+        self.by_vpc = {}
+        self.public_ips = set()
+        res_ids = {}
+        for tag in self.describe_tags({'key': 'Name', 'value': '{0}*'.format(tag_prefix)}):
+            res_ids.setdefault(tag.res_type, []).append(tag.res_id)
+        for res_type, (describe, id_filter) in DESCRIBE.items():
+            if not res_ids.get(res_type):
+                continue
+            # Filters rather than ids, a resource deleted since DescribeTags is not an error
+            for resource in getattr(self.ocb.fcu, describe)(filters={id_filter: res_ids[res_type]}):
+                if res_type == 'instance':
+                    # Terminated instances keep their tags for a while
+                    if resource.state == 'terminated':
+                        continue
+                    if resource.tags.get(EIP_TAG):
+                        self.public_ips.add(resource.tags[EIP_TAG])
+                    vpc_id = resource.vpc_id
+                elif res_type == 'vpc':
+                    vpc_id = resource.id
+                elif res_type == 'internet-gateway':
+                    vpc_id = resource.attachments[0].vpc_id if resource.attachments else None
+                else:
+                    vpc_id = resource.vpc_id
+                self.by_vpc.setdefault(vpc_id, {}).setdefault(res_type, []).append(resource)
+        self.ocb.log('Tag prefix {0}: {1} resources in {2} VPCs'.format(
+            tag_prefix, sum(len(resources) for by_type in self.by_vpc.values() for resources in by_type.values()),
+            len(self.vpcs())), 'info')
+        return self
+
+    def vpcs(self):
+        """
+        :return: ids of the VPCs holding indexed resources
+        :rtype: list
+        """
+        return sorted(vpc_id for vpc_id in self.by_vpc if vpc_id)
+
+    def resources(self, vpc_id, res_type):
+        """
+        :param vpc_id: vpc id, None for resources outside any VPC
+        :type vpc_id: str
+        :param res_type: DescribeTags resource type (subnet, route-table...)
+        :type res_type: str
+        :return: indexed resources of res_type in vpc_id
+        :rtype: list
+        """
+        return self.by_vpc.get(vpc_id, {}).get(res_type, [])
+
+    def orphans(self):
+        """
+        :return: resource ids by type of indexed resources outside any VPC
+        :rtype: dict
+        """
+        return dict((res_type, [resource.id for resource in resources])
+                    for res_type, resources in self.by_vpc.get(None, {}).items())
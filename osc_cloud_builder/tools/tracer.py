@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Trace provisioning runs.
+Functions decorated with traced(), API calls and sleeps are recorded as spans
+while a Tracer is active. Spans are exported as Chrome trace-event JSON (open
+it in chrome://tracing or https://ui.perfetto.dev) and summarized as the
+critical path of the run.
+
+    >>>tracer = Tracer()
+    >>>with tracer.activate():
+    >>>    vpc, instance_bouncer, instance_private = setup_vpc(omi_id, key_name)
+    >>>tracer.export('/tmp/setup_vpc.trace.json')
+    >>>print tracer.summary()
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import os
+import json
+import time
+import threading
+import itertools
+from functools import wraps
+from contextlib import contextmanager
+from osc_cloud_builder.OCBase import OCBase, OCBError
+
+# Activation is process-wide: it patches time.sleep and the shared OCBase connections
+_ACTIVE = {'tracer': None}
+_ACTIVE_LOCK = threading.Lock()
+
+
+def traced(func):
+    """
+    Record a span for each call of func when a tracer is active
+    :param func: function to trace
+    :type func: function
+    :return: decorated function
+    :rtype: function
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        tracer = _ACTIVE['tracer']
+        if tracer is None:
+            return func(*args, **kwargs)
+        with tracer.span(func.__name__, 'step'):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class Tracer(object):
+    """
+    Collect spans with their thread and parent span
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.__ids = itertools.count(1)
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+    @contextmanager
+    def span(self, name, category='step', **args):
+        """
+        Record the enclosed block as a span
+        :param name: span name
+        :type name: str
+        :param category: step, api or sleep
+        :type category: str
+        :param args: extra values displayed in the trace viewer
+        :type args: dict
+        """
+        stack = getattr(self.__local, 'stack', None)
+        if stack is None:
+            stack = self.__local.stack = []
+        span = {'id': next(self.__ids), 'name': name, 'cat': category, 'args': args,
+                'tid': threading.current_thread().ident, 'parent': stack[-1]['id'] if stack else None,
+                'start': time.time(), 'end': None}
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            span['end'] = time.time()
+            stack.pop()
+            with self.__lock:
+                self.spans.append(span)
+
+    @contextmanager
+    def activate(self, ocb=None):
+        """
+        Make this tracer active: traced() functions, FCU and LBU requests and
+        time.sleep calls of every thread are recorded until the block exits.
+        Activation is process-wide, a single tracer can be active at a time.
+        :param ocb: connection object, OCBase() is used if not set
+        :type ocb: OCBase.OCBase
+        :raises OCBError: When a tracer is already active
+        """
+        ocb = ocb or OCBase()
+        with _ACTIVE_LOCK:
+            if _ACTIVE['tracer'] is not None:
+                raise OCBError('A tracer is already active, activation is process-wide and can not be nested')
+            _ACTIVE['tracer'] = self
+        connections = [conn for conn in (ocb.fcu, ocb.lbu) if conn is not None]
+        previous = [(conn, conn.__dict__.get('make_request')) for conn in connections]
+        sleep = time.sleep
+
+        def traced_sleep(seconds):
+            with self.span('sleep', 'sleep', seconds=seconds):
+                sleep(seconds)
+
+        def traced_request(conn):
+            make_request = conn.make_request
+
+            def wrapper(action, *args, **kwargs):
+                with self.span(action, 'api', host=conn.host):
+                    return make_request(action, *args, **kwargs)
+            return wrapper
+
+        for conn in connections:
+            conn.make_request = traced_request(conn)
+        time.sleep = traced_sleep
+        try:
+            yield self
+        finally:
+            time.sleep = sleep
+            for conn, make_request in previous:
+                if make_request is None:
+                    del conn.make_request
+                else:
+                    conn.make_request = make_request
+            _ACTIVE['tracer'] = None
+
+    def to_chrome_trace(self):
+        """
+        :return: spans in Chrome trace-event format
+        :rtype: dict
+        """
+        pid = os.getpid()
+        events = [{'name': span['name'], 'cat': span['cat'], 'ph': 'X', 'pid': pid, 'tid': span['tid'],
+                   'ts': int(span['start'] * 1e6), 'dur': int((span['end'] - span['start']) * 1e6),
+                   'args': span['args']}
+                  for span in self.spans]
+        return {'traceEvents': sorted(events, key=lambda event: event['ts']), 'displayTimeUnit': 'ms'}
+
+    def export(self, path):
+        """
+        Write Chrome trace-event JSON file
+        :param path: trace file path
+        :type path: str
+        """
+        with open(path, 'w') as trace_file:
+            json.dump(self.to_chrome_trace(), trace_file)
+
+    def __children(self):
+        """
+        Spans by parent id. A span recorded on a thread started under a span has
+        no parent on its own thread, its parent is the innermost span of another
+        thread which started before it and encloses it in time.
+        :return: children spans by parent id, top-level spans under None
+        :rtype: dict
+        """
+        children = {}
+        for span in self.spans:
+            parent = span['parent']
+            if parent is None:
+                enclosing = [other for other in self.spans
+                             if other['tid'] != span['tid'] and other['id'] < span['id']
+                             and other['start'] <= span['start'] and span['end'] <= other['end']]
+                if enclosing:
+                    parent = max(enclosing, key=lambda other: other['start'])['id']
+            children.setdefault(parent, []).append(span)
+        return children
+
+    def __totals(self, children, span_id, category):
+        """
+        :return: time spent and number of spans of category under span_id
+        :rtype: tuple
+        """
+        duration, count = 0, 0
+        for child in children.get(span_id, []):
+            if child['cat'] == category:
+                duration += child['end'] - child['start']
+                count += 1
+            else:
+                child_duration, child_count = self.__totals(children, child['id'], category)
+                duration += child_duration
+                count += child_count
+        return duration, count
+
+    def critical_path(self, children=None):
+        """
+        Walk back from the end of the run, taking each time the span which
+        finished last before the current one started.
+        :return: top-level spans of the run, or steps of the single step traced
+        :rtype: list
+        """
+        children = children or self.__children()
+        spans = children.get(None, [])
+        steps = [span for span in spans if span['cat'] == 'step']
+        if len(steps) == 1:
+            spans = children.get(steps[0]['id'], [])
+        path = []
+        cursor = float('inf')
+        while True:
+            candidates = [span for span in spans if span['end'] <= cursor]
+            if not candidates:
+                break
+            span = max(candidates, key=lambda span: span['end'])
+            path.insert(0, span)
+            cursor = span['start']
+        return path
+
+    def summary(self):
+        """
+        :return: critical path and sleep time report
+        :rtype: str
+        """
+        if not self.spans:
+            return 'No span recorded'
+        start = min(span['start'] for span in self.spans)
+        end = max(span['end'] for span in self.spans)
+        total_sleep = sum(span['end'] - span['start'] for span in self.spans if span['cat'] == 'sleep')
+        lines = ['Total time: {0:.2f}s, total sleep time: {1:.2f}s'.format(end - start, total_sleep),
+                 'Critical path:']
+        children = self.__children()
+        for span in self.critical_path(children):
+            duration = span['end'] - span['start']
+            sleep_time = self.__totals(children, span['id'], 'sleep')[0]
+            api_time, api_calls = self.__totals(children, span['id'], 'api')
+            lines.append('  {0:<40} {1:>8.2f}s {2:>5.1f}%  sleep {3:.2f}s  api {4:.2f}s in {5} calls'.format(
+                span['name'], duration, 100 * duration / max(end - start, 1e-9), sleep_time, api_time, api_calls))
+        return '\n'.join(lines)
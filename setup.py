@@ -81,4 +81,9 @@ setup(
         'boto==2.42.0',
         'lxml==3.6.4',
     ],
+
+    # Dependencies of optional tools, installed with pip install osc_cloud_builder[ssh]
+    extras_require={
+        'ssh': ['paramiko'],
+    },
 )
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Local SSH server stand-in for a bouncer and the private instances behind it.
+The bouncer listens on localhost, direct-tcpip channels opened through it are
+served in-process as the SSH server of the requested address, and exec
+requests answer with a line naming the host and the command.
+
+    >>>server = LocalSSHServer().start()
+    >>>executor = BouncerExecutor(server.address, server.key_path, port=server.port)
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import os
+import time
+import socket
+import tempfile
+import threading
+import paramiko
+
+
+class _Handler(paramiko.ServerInterface):
+    """
+    SSH server of one host, the bouncer or a private instance
+    """
+
+    def __init__(self, server, address, is_bouncer):
+        self.server = server
+        self.address = address
+        self.is_bouncer = is_bouncer
+        self.tunnels = {}
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        if not self.is_bouncer:
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+        self.tunnels[chanid] = destination[0]
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self.server.execute, args=(self.address, channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class LocalSSHServer(object):
+    """
+    Bouncer stand-in listening on localhost
+        - connections: number of SSH connections to the bouncer
+        - hosts: number of SSH connections through the bouncer by address
+        - commands: (address, command) of each exec request
+        - max_running: highest number of commands running at the same time
+    """
+
+    def __init__(self, command_delay=0.2):
+        """
+        :param command_delay: seconds each command runs
+        :type command_delay: float
+        """
+        self.command_delay = command_delay
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.client_key = paramiko.RSAKey.generate(2048)
+        key_fd, self.key_path = tempfile.mkstemp(suffix='.rsa')
+        os.close(key_fd)
+        self.client_key.write_private_key_file(self.key_path)
+        self.address = '127.0.0.1'
+        self.port = None
+        self.connections = 0
+        self.hosts = {}
+        self.commands = []
+        self.max_running = 0
+        self.__running = 0
+        self.__lock = threading.Lock()
+        self.__socket = None
+        self.__transports = []
+
+    def start(self):
+        """
+        Listen on a free localhost port
+        :return: self
+        :rtype: LocalSSHServer
+        """
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__socket.bind((self.address, 0))
+        self.__socket.listen(16)
+        self.port = self.__socket.getsockname()[1]
+        thread = threading.Thread(target=self.__accept)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        """
+        Close the listening socket and every connection
+        """
+        self.__socket.close()
+        for transport in self.__transports:
+            transport.close()
+        os.remove(self.key_path)
+
+    def __accept(self):
+        while True:
+            try:
+                sock, _ = self.__socket.accept()
+            except (socket.error, OSError):
+                return
+            with self.__lock:
+                self.connections += 1
+            self.__serve(sock, self.address, is_bouncer=True)
+
+    def __serve(self, sock, address, is_bouncer):
+        """
+        Run an SSH server on sock and dispatch its channels in background
+        :param sock: socket or direct-tcpip channel
+        :type sock: socket.socket or paramiko.Channel
+        :param address: address the server stands for
+        :type address: str
+        :param is_bouncer: allow direct-tcpip channels
+        :type is_bouncer: bool
+        """
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(self.host_key)
+        handler = _Handler(self, address, is_bouncer)
+        transport.start_server(server=handler)
+        self.__transports.append(transport)
+        thread = threading.Thread(target=self.__channels, args=(transport, handler))
+        thread.daemon = True
+        thread.start()
+
+    def __channels(self, transport, handler):
+        sessions = []
+        while transport.is_active():
+            channel = transport.accept(1)
+            if channel is None:
+                continue
+            if channel.get_id() not in handler.tunnels:
+                # Session channels are closed when garbage collected
+                sessions.append(channel)
+                continue
+            address = handler.tunnels.pop(channel.get_id())
+            with self.__lock:
+                self.hosts[address] = self.hosts.get(address, 0) + 1
+            thread = threading.Thread(target=self.__serve, args=(channel, address, False))
+            thread.daemon = True
+            thread.start()
+
+    def execute(self, address, channel, command):
+        """
+        Answer an exec request with '<address> <command>', exit status 0
+        """
+        if isinstance(command, bytes):
+            command = command.decode('utf-8')
+        with self.__lock:
+            self.commands.append((address, command))
+            self.__running += 1
+            self.max_running = max(self.max_running, self.__running)
+        time.sleep(self.command_delay)
+        with self.__lock:
+            self.__running -= 1
+        channel.sendall('{0} {1}\n'.format(address, command).encode('utf-8'))
+        channel.send_exit_status(0)
+        channel.close()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+BouncerExecutor against the local SSH server stand-in
+    python -m unittest discover tests
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import threading
+import unittest
+from osc_cloud_builder.tools.ssh_executor import BouncerExecutor
+from ssh_server import LocalSSHServer
+
+ADDRESSES = ['10.0.2.{0}'.format(i) for i in range(1, 9)]
+
+
+class BouncerExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalSSHServer().start()
+        self.executor = BouncerExecutor(self.server.address, self.server.key_path, user='test',
+                                        max_workers=4, port=self.server.port, connection_attempts=1, timeout=10)
+
+    def tearDown(self):
+        self.executor.close()
+        self.server.stop()
+
+    def test_run_concurrently(self):
+        results = self.executor.run(ADDRESSES, 'uptime')
+        self.assertEqual(sorted(results), sorted(ADDRESSES))
+        self.assertTrue(1 < self.server.max_running <= 4)
+
+    def test_output_by_host(self):
+        lock = threading.Lock()
+        streamed = []
+
+        def on_output(address, line):
+            with lock:
+                streamed.append((address, line))
+
+        results = self.executor.run(ADDRESSES, 'hostname', on_output)
+        for address in ADDRESSES:
+            self.assertEqual(results[address], (0, ['{0} hostname'.format(address)]))
+        self.assertEqual(sorted(streamed), sorted((address, '{0} hostname'.format(address)) for address in ADDRESSES))
+
+    def test_connections_reused(self):
+        self.executor.run(ADDRESSES, 'uptime')
+        self.executor.run(ADDRESSES, 'hostname')
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.hosts, dict((address, 1) for address in ADDRESSES))
+        self.assertEqual(len(self.server.commands), 2 * len(ADDRESSES))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Tracer spans of steps run on their own thread
+    python -m unittest discover tests
+"""
+
+__author__      = "Heckle"
+__copyright__   = "BSD"
+
+import time
+import threading
+import unittest
+from osc_cloud_builder.tools.tracer import Tracer, traced
+
+
+class _NoConnection(object):
+    """
+    OCBase stand-in without FCU and LBU connections
+    """
+    fcu = None
+    lbu = None
+
+
+@traced
+def step_a():
+    time.sleep(0.05)
+
+
+@traced
+def step_b():
+    time.sleep(0.05)
+
+
+@traced
+def run():
+    step_a()
+    thread = threading.Thread(target=step_b)
+    thread.start()
+    thread.join()
+
+
+class TracerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tracer = Tracer()
+        with self.tracer.activate(_NoConnection()):
+            run()
+
+    def test_thread_span_has_no_parent_on_its_thread(self):
+        spans = dict((span['name'], span) for span in self.tracer.spans)
+        self.assertNotEqual(spans['step_b']['tid'], spans['run']['tid'])
+        self.assertIsNone(spans['step_b']['parent'])
+
+    def test_critical_path_goes_through_thread(self):
+        self.assertEqual([span['name'] for span in self.tracer.critical_path()], ['step_a', 'step_b'])
+
+    def test_summary_of_thread_step(self):
+        summary = self.tracer.summary()
+        self.assertNotIn('  run ', summary)
+        step_b = [line for line in summary.split('\n') if line.strip().startswith('step_b')]
+        self.assertEqual(len(step_b), 1)
+        self.assertNotIn('sleep 0.00s', step_b[0])
+
+
+if __name__ == '__main__':
+    unittest.main()